@@ -0,0 +1,294 @@
+import os
+import sys
+import json
+import logging
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, timezone
+
+# =============================
+# FAKE UPSTREAMS
+# =============================
+class FakeClash:
+    def __init__(self, tags, latency, seed):
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.logs = {tag: [] for tag in tags}
+        start = datetime.combine(
+            datetime.now(timezone.utc).date() - timedelta(days=1),
+            datetime.min.time(),
+            tzinfo=timezone.utc
+        ) + timedelta(hours=1)
+        self.clock = {tag: start for tag in tags}
+        self.lock = threading.Lock()
+
+    def advance(self, count):
+        # ---- Каждый тег сыграл ещё count боёв ----
+        with self.lock:
+            for tag, log in self.logs.items():
+                for _ in range(count):
+                    self.clock[tag] += timedelta(minutes=1)
+                    log.insert(0, self.make_battle(tag, self.clock[tag]))
+                del log[25:]
+
+    def make_battle(self, tag, battle_time):
+        won = self.random.random() < 0.55
+        crowns = self.random.randint(1, 3)
+        other = self.random.randint(0, crowns - 1)
+        trophy_change = self.random.randint(25, 35)
+        return {
+            "battleTime": battle_time.strftime("%Y%m%dT%H%M%S.000Z"),
+            "type": "PvP",
+            "gameMode": {"name": "Ladder"},
+            "team": [{
+                "name": f"Player {tag}",
+                "crowns": crowns if won else other,
+                "trophyChange": trophy_change if won else -trophy_change,
+                "startingTrophies": 7000
+            }],
+            "opponent": [{
+                "name": "Opponent",
+                "crowns": other if won else crowns,
+                "startingTrophies": 7000
+            }]
+        }
+
+    def battle_log(self, tag):
+        with self.lock:
+            log = self.logs.get(tag)
+            return None if log is None else list(log)
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, method):
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.counts.values())
+
+
+def start_upstreams(clash, telegram):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # ---- Заголовки и тело одной записью, иначе Nagle + delayed ACK дают +40ms ----
+        wbufsize = 64 * 1024
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            # ---- Как у настоящего API: ETag по телу, 304 на совпадающий If-None-Match ----
+            etag = f'"{hashlib.md5(body).hexdigest()}"'
+            if status == 200 and self.headers.get("If-None-Match") == etag:
+                status, body = 304, b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            if status in (200, 304):
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            # /v1/players/%23TAG/battlelog
+            parts = self.path.split("/")
+            if len(parts) == 5 and parts[4] == "battlelog":
+                time.sleep(clash.latency)
+                log = clash.battle_log("#" + parts[3].replace("%23", ""))
+                if log is None:
+                    self.reply(404, {"reason": "notFound"})
+                else:
+                    self.reply(200, log)
+            elif len(parts) == 4 and parts[2] == "players":
+                self.reply(200, {"name": "Player"})
+            else:
+                self.reply(404, {"reason": "notFound"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            telegram.record(self.path.rsplit("/", 1)[-1])
+            self.reply(200, {"ok": True, "result": {}})
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+# =============================
+# INSTRUMENTATION
+# =============================
+class Timings:
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.samples.setdefault(phase, []).append(seconds)
+
+    def reset(self):
+        with self.lock:
+            samples = self.samples
+            self.samples = {}
+        return samples
+
+
+class TimedStorage:
+    def __init__(self, storage, timings):
+        self.storage = storage
+        self.timings = timings
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.timings.add("db", time.perf_counter() - started)
+        return timed
+
+
+def timed_call(fn, timings, phase):
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            timings.add(phase, time.perf_counter() - started)
+    return timed
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def phase_line(name, values):
+    if not values:
+        return f"  {name:<8} -"
+    return (
+        f"  {name:<8} n={len(values):<6} total={sum(values):8.3f}s "
+        f"p50={percentile(values, 0.5) * 1000:7.2f}ms "
+        f"p99={percentile(values, 0.99) * 1000:7.2f}ms "
+        f"max={max(values) * 1000:7.2f}ms"
+    )
+
+# =============================
+# RUN
+# =============================
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for the check and daily pipelines")
+    parser.add_argument("--tags", type=int, default=200)
+    parser.add_argument("--subscribers", type=int, default=3, help="subscribers per tag")
+    parser.add_argument("--new-battles", type=int, default=2, help="new battles per tag per pass")
+    parser.add_argument("--passes", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake battlelog latency, seconds")
+    parser.add_argument("--tg-rate", type=float, default=1000, help="Telegram global messages/sec")
+    parser.add_argument("--tg-chat-interval", type=float, default=1,
+                        help="min seconds between messages to one chat (production default 1)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    tags = [f"#BENCH{i}" for i in range(args.tags)]
+    clash = FakeClash(tags, args.latency, args.seed)
+    telegram = FakeTelegram()
+    base_url = start_upstreams(clash, telegram)
+    workdir = tempfile.mkdtemp(prefix="cr-bench-")
+
+    os.environ.update({
+        "STORAGE_BACKEND": "sqlite",
+        "SQLITE_PATH": os.path.join(workdir, "bench.db"),
+        "CLASH_API_URL": f"{base_url}/v1",
+        "TELEGRAM_API_URL": base_url,
+        "TG_GLOBAL_RATE": str(args.tg_rate),
+        "TG_CHAT_INTERVAL": str(args.tg_chat_interval),
+        "CLASH_RATE_LIMIT": os.environ.get("CLASH_RATE_LIMIT", "1000"),
+        "CR_TOKEN": "bench",
+        "TG_TOKEN": "bench"
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as app
+    logging.getLogger().setLevel(logging.WARNING)
+
+    timings = Timings()
+    app.storage = TimedStorage(app.storage, timings)
+    app.get_battle_log = timed_call(app.get_battle_log, timings, "fetch")
+
+    # ---- Подписчики: каждый юзер следит за одним тегом и получает по нему daily ----
+    chat_id = 1
+    for tag in tags:
+        for _ in range(args.subscribers):
+            app.storage.ensure_user(chat_id, None)
+            app.storage.add_subscription(chat_id, tag)
+            app.storage.set_daily_player(chat_id, tag, None)
+            chat_id += 1
+    timings.reset()
+
+    print(f"tags={args.tags} subscribers/tag={args.subscribers} "
+          f"new battles/tag/pass={args.new_battles} latency={args.latency * 1000:.0f}ms "
+          f"tg rate={args.tg_rate:g}/s chat interval={args.tg_chat_interval:g}s")
+
+    for n in range(1, args.passes + 1):
+        # ---- Первый проход: полный лог из 25 боёв (холодный старт) ----
+        clash.advance(25 if n == 1 else args.new_battles)
+        sent_before = telegram.total()
+        battles_before = sum(app.storage.count_battles(tag) for tag in tags)
+        timings.reset()
+
+        started = time.perf_counter()
+        app.check_new_battles()
+        scan = time.perf_counter() - started
+        samples = timings.reset()
+        app.telegram_dispatcher.drain()
+        total = time.perf_counter() - started
+
+        new = sum(app.storage.count_battles(tag) for tag in tags) - battles_before
+        timings.reset()
+        messages = telegram.total() - sent_before
+        db_calls = len(samples.get("db", []))
+
+        print(f"\npass {n}: {new} new battles, scan {scan:.3f}s, with delivery {total:.3f}s")
+        print(f"  throughput   {args.tags / scan:9.1f} tags/s  {new / scan if new else 0:9.1f} battles/s")
+        print(f"  db calls     {db_calls} ({db_calls / new if new else float(db_calls):.2f} per new battle)")
+        print(f"  messages     {messages} ({messages / total if total else 0:.1f} msg/s)")
+        print(phase_line("fetch", samples.get("fetch", [])))
+        print(phase_line("db", samples.get("db", [])))
+
+    # ---- Daily: отчёты за вчера по всем подписчикам ----
+    sent_before = telegram.total()
+    timings.reset()
+    started = time.perf_counter()
+    app.send_daily_reports()
+    build = time.perf_counter() - started
+    samples = timings.reset()
+    app.telegram_dispatcher.drain()
+    total = time.perf_counter() - started
+    messages = telegram.total() - sent_before
+
+    print(f"\ndaily: build {build:.3f}s, with delivery {total:.3f}s")
+    print(f"  db calls     {len(samples.get('db', []))}")
+    print(f"  messages     {messages} ({messages / total if total else 0:.1f} msg/s)")
+    print(phase_line("db", samples.get("db", [])))
+
+
+if __name__ == "__main__":
+    main()
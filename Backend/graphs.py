@@ -0,0 +1,54 @@
+import io
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# ---- Только numpy и matplotlib: spawn-воркеры пула графиков импортируют этот модуль, а не main ----
+
+def downsample_lttb(x, y, threshold):
+    # ---- Largest-Triangle-Three-Buckets: меньше точек, та же форма кривой ----
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+
+    every = (n - 2) / (threshold - 2)
+    picked = np.empty(threshold, dtype=np.int64)
+    picked[0] = 0
+    picked[-1] = n - 1
+    a = 0
+
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+
+        areas = np.abs(
+            (x[a] - avg_x) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (avg_y - y[a])
+        )
+        a = start + int(areas.argmax())
+        picked[i + 1] = a
+
+    return x[picked], y[picked]
+
+def winrate_series(results):
+    wins = np.fromiter((bool(r) for r in results), dtype=np.float64, count=len(results))
+    games = np.arange(1, len(wins) + 1, dtype=np.float64)
+    return games, np.cumsum(wins) / games * 100
+
+def render_winrate_png(tag, games, rates):
+    # ---- Без pyplot: своя фигура на каждый рендер, никакого глобального состояния ----
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    ax.plot(games, rates)
+    ax.set_xlabel("Games")
+    ax.set_ylabel("Winrate %")
+    ax.set_title(f"Winrate progression for {tag}")
+    ax.set_ylim(0, 100)
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
@@ -1,14 +1,31 @@
 import os
+import sys
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 import urllib.parse
 import threading
-import io
 import random
-import matplotlib.pyplot as plt
-from flask import Flask, request
+import time
+import queue
+import math
+import heapq
+import itertools
+import bisect
+import hashlib
+import socket
+import uuid
+import atexit
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, request, jsonify
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from storage import create_storage, InstrumentedStorage
+from graphs import downsample_lttb, winrate_series, render_winrate_png
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from datetime import datetime, timedelta, timezone
 
 load_dotenv()
@@ -16,8 +33,87 @@ CR_TOKEN = os.getenv("CR_TOKEN")
 TG_TOKEN = os.getenv("TG_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "notifier.db")
+CLASH_API_URL = os.getenv("CLASH_API_URL", "https://proxy.royaleapi.dev/v1")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+CLASH_TIMEOUT = float(os.getenv("CLASH_TIMEOUT", 10))
+TG_TIMEOUT = float(os.getenv("TG_TIMEOUT", 10))
+TG_UPLOAD_TIMEOUT = float(os.getenv("TG_UPLOAD_TIMEOUT", 20))
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 8))
+CLASH_RATE_LIMIT = float(os.getenv("CLASH_RATE_LIMIT", 10))
+CLASH_CACHE_SIZE = int(os.getenv("CLASH_CACHE_SIZE", 5000))
+CLASH_PROFILE_TTL = float(os.getenv("CLASH_PROFILE_TTL", 3600))
+CLASH_RETRIES = int(os.getenv("CLASH_RETRIES", 2))
+CLASH_RETRY_BASE = float(os.getenv("CLASH_RETRY_BASE", 0.5))
+CLASH_RETRY_MAX_DELAY = float(os.getenv("CLASH_RETRY_MAX_DELAY", 10))
+CLASH_BREAKER_THRESHOLD = int(os.getenv("CLASH_BREAKER_THRESHOLD", 5))
+CLASH_BREAKER_RESET = float(os.getenv("CLASH_BREAKER_RESET", 30))
+QUARANTINE_AFTER = int(os.getenv("QUARANTINE_AFTER", 3))
+QUARANTINE_BASE = float(os.getenv("QUARANTINE_BASE", 600))
+QUARANTINE_MAX = float(os.getenv("QUARANTINE_MAX", 86400))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_LIMIT = int(os.getenv("WEBHOOK_QUEUE_LIMIT", 100))
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", 1000))
+DAILY_LOG_BATCH = 50
+SUBSCRIPTIONS_REFRESH = float(os.getenv("SUBSCRIPTIONS_REFRESH", 600))
+GRAPH_CACHE_SIZE = int(os.getenv("GRAPH_CACHE_SIZE", 128))
+GRAPH_PROCESSES = int(os.getenv("GRAPH_PROCESSES", 2))
+GRAPH_MAX_POINTS = int(os.getenv("GRAPH_MAX_POINTS", 1000))
+GRAPH_RENDER_TIMEOUT = float(os.getenv("GRAPH_RENDER_TIMEOUT", 60))
+KNOWN_USERS_CACHE_SIZE = int(os.getenv("KNOWN_USERS_CACHE_SIZE", 10000))
+KNOWN_USERS_TTL = float(os.getenv("KNOWN_USERS_TTL", 3600))
+TG_WORKERS = int(os.getenv("TG_WORKERS", 4))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))
+TG_CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", 1))
+TG_MAX_ATTEMPTS = int(os.getenv("TG_MAX_ATTEMPTS", 5))
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "1") == "1"
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 30))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", 1800))
+POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", 2))
+SCAN_BUDGET = float(os.getenv("SCAN_BUDGET", 0))
+CATCHUP_THRESHOLD = int(os.getenv("CATCHUP_THRESHOLD", 3))
+CLUSTER_MODE = os.getenv("CLUSTER_MODE", "0") == "1"
+INSTANCE_ID = os.getenv("INSTANCE_ID")
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", 15))
+LEASE_TTL = float(os.getenv("LEASE_TTL", 60))
+CLUSTER_VNODES = int(os.getenv("CLUSTER_VNODES", 64))
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# =============================
+# METRICS
+# =============================
+BATTLELOG_SECONDS = Histogram(
+    "clash_battlelog_fetch_seconds", "Battle log fetch latency", ["outcome"]
+)
+DB_CALL_SECONDS = Histogram(
+    "db_call_seconds", "Storage call latency", ["table", "operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+TELEGRAM_SEND_SECONDS = Histogram(
+    "telegram_send_seconds", "Telegram API request latency", ["method"]
+)
+CHECK_PASS_SECONDS = Histogram(
+    "check_pass_seconds", "Duration of a full battle check pass (/check)",
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+SCHEDULER_BATCH_SECONDS = Histogram(
+    "scheduler_batch_seconds", "Duration of a poll scheduler batch",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+)
+NEW_BATTLES = Counter("new_battles_total", "New battles stored")
+NOTIFICATIONS_SENT = Counter("notifications_sent_total", "Telegram messages delivered", ["method"])
+NOTIFICATIONS_FAILED = Counter("notifications_failed_total", "Telegram messages dropped", ["method"])
+CACHE_REQUESTS = Counter("cache_requests_total", "In-process cache lookups", ["cache", "result"])
+CLASH_RETRIES_TOTAL = Counter("clash_retries_total", "Clash API request retries")
+BREAKER_STATE = Gauge("circuit_breaker_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open", ["breaker"])
+
+def observe_db_call(table, operation, seconds):
+    DB_CALL_SECONDS.labels(table, operation).observe(seconds)
+
+storage = InstrumentedStorage(
+    create_storage(STORAGE_BACKEND, SUPABASE_URL, SUPABASE_KEY, SQLITE_PATH),
+    observe_db_call
+)
 from flask import send_from_directory
 
 app = Flask(__name__)
@@ -143,13 +239,13 @@ mid_results = [
 
 def get_player_name(tag):
     tag = tag.replace("#", "")
-    url = f"https://proxy.royaleapi.dev/v1/players/%23{tag}"
-    headers = {"Authorization": f"Bearer {CR_TOKEN}"} 
-    r = requests.get(url, headers=headers, timeout=10)
-    if r.status_code != 200:
+    try:
+        status, data = clash_responses.fetch(f"/players/%23{tag}", CLASH_PROFILE_TTL)
+    except Exception as e:
+        logging.error(f"Player profile request failed: {e}")
+        return None
+    if status != 200:
         return None
-
-    data = r.json()
 
     return data.get("name")
 
@@ -161,248 +257,723 @@ def get_random_streak_message(streak, pool):
 
     level = max(eligible)
     return random.choice(pool[level])
-def check_new_battles():
+# =============================
+# SUBSCRIPTIONS
+# =============================
+class SubscriptionIndex:
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self.by_tag = {}
+        self.by_user = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        # ---- Одновременно идёт только одна перезагрузка ----
+        self.reload_lock = threading.Lock()
+        # ---- Пока идёт перезагрузка, add/remove пишутся сюда и доприменяются к новым картам ----
+        self.changes = None
+
+    def reload(self):
+        with self.reload_lock:
+            self._load()
+
+    def _load(self):
+        with self.lock:
+            self.changes = []
+        try:
+            rows = storage.all_subscriptions()
+        except Exception:
+            with self.lock:
+                self.changes = None
+            raise
+        by_tag = {}
+        by_user = {}
+        for row in rows:
+            by_tag.setdefault(row["player_tag"], set()).add(row["user_id"])
+            by_user.setdefault(row["user_id"], set()).add(row["player_tag"])
+        with self.lock:
+            self.by_tag = by_tag
+            self.by_user = by_user
+            # ---- Правки из /add и /remove, пришедшие между чтением и заменой, не теряем ----
+            for apply, user_id, tag in self.changes:
+                apply(user_id, tag)
+            self.changes = None
+            self.loaded_at = time.monotonic()
+
+    def is_stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh_interval
+
+    def ensure_loaded(self):
+        # ---- Периодически сверяемся с БД на случай правок из других процессов ----
+        if not self.is_stale():
+            return
+        with self.reload_lock:
+            # ---- Пока ждали блокировку, перезагрузку мог сделать другой поток ----
+            if self.is_stale():
+                self._load()
+
+    def add(self, user_id, tag):
+        with self.lock:
+            self._add(user_id, tag)
+            if self.changes is not None:
+                self.changes.append((self._add, user_id, tag))
+
+    def remove(self, user_id, tag):
+        with self.lock:
+            self._remove(user_id, tag)
+            if self.changes is not None:
+                self.changes.append((self._remove, user_id, tag))
+
+    def _add(self, user_id, tag):
+        self.by_tag.setdefault(tag, set()).add(user_id)
+        self.by_user.setdefault(user_id, set()).add(tag)
+
+    def _remove(self, user_id, tag):
+        users = self.by_tag.get(tag)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self.by_tag[tag]
+        tags = self.by_user.get(user_id)
+        if tags is not None:
+            tags.discard(tag)
+            if not tags:
+                del self.by_user[user_id]
+
+    def is_subscribed(self, user_id, tag):
+        self.ensure_loaded()
+        with self.lock:
+            return tag in self.by_user.get(user_id, ())
+
+    def tags(self):
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.by_tag)
+
+    def subscribers(self, tag):
+        self.ensure_loaded()
+        with self.lock:
+            return list(self.by_tag.get(tag, ()))
+
+subscription_index = SubscriptionIndex(SUBSCRIPTIONS_REFRESH)
+
+def is_tracking(chat_id, tag):
+    if subscription_index.is_subscribed(chat_id, tag):
+        return True
+    # ---- Индекс мог устареть (подписка из другого процесса): проверяем в БД ----
+    exists = storage.has_subscription(chat_id, tag)
+    if exists:
+        subscription_index.add(chat_id, tag)
+    return exists
+
+# =============================
+# BATTLE CURSORS
+# =============================
+battle_cursors = {}
+cursors_lock = threading.Lock()
+cursors_loaded = False
+
+def load_battle_cursors():
+    global cursors_loaded
+    with cursors_lock:
+        if cursors_loaded:
+            return
+        for row in storage.load_cursors():
+            battle_cursors[row["player_tag"]] = datetime.fromisoformat(row["last_battle_time"])
+        cursors_loaded = True
+
+def save_battle_cursor(tag, parsed_time):
+    storage.save_cursor(tag, parsed_time.isoformat())
+    battle_cursors[tag] = parsed_time
+
+def latest_battle_time(battles):
     try:
-        subscriptions = supabase.table("user_players") \
-            .select("user_id, player_tag") \
-            .execute().data
-        if not subscriptions:
-            logging.info("No tracked players.")
+        return parse_battle_time(battles[0]["battleTime"])
+    except Exception:
+        return None
+
+# =============================
+# SCAN PRIORITY
+# =============================
+RECENT_ACTIVITY = timedelta(hours=1)
+# tag -> datetime последнего опроса (persist в player_polls)
+poll_times = {}
+poll_times_loaded = False
+
+def load_poll_times():
+    global poll_times_loaded
+    with cursors_lock:
+        if poll_times_loaded:
             return
-        # ---- Уникальные player_tag ----
-        unique_tags = list(set(sub["player_tag"] for sub in subscriptions))
-        for tag in unique_tags:
-            battles = get_battle_log(tag)
-            if not battles:
-                continue
-            for battle in battles:
-                battle_time = battle["battleTime"]
-                exists = supabase.table("battles") \
-                    .select("id") \
-                    .eq("player_tag", tag) \
-                    .eq("battle_time", battle_time) \
-                    .execute()
-                if exists.data:
-                    continue
-                try:
-                    result = battle["team"][0]["crowns"] > battle["opponent"][0]["crowns"]
-                except:
-                    continue
-                # ---- Сохраняем бой ----
-                raw_time = battle["battleTime"]
-                parsed_time = datetime.strptime(
-                    raw_time, "%Y%m%dT%H%M%S.%fZ"
-                ).replace(tzinfo=timezone.utc)
-                battle_time = parsed_time.isoformat()
-                battle_hour = parsed_time.hour
-                today = parsed_time.date()
-                today_battles = supabase.table("battles") \
-                    .select("id") \
-                    .eq("player_tag", tag) \
-                    .gte("battle_time", today.isoformat()) \
-                    .limit(1) \
-                    .execute().data
-                is_first_game = len(today_battles) == 0
-                is_night = battle_hour >= 0 and battle_hour < 6
-                night_line = ""
-                if is_night:
-                    if result:
-                        night_line = random.choice(NIGHT_WIN_MESSAGES)
-                    else:
-                        night_line = random.choice(NIGHT_LOSE_MESSAGES)
-
-                supabase.table("battles").insert({
-                    "player_tag": tag,
-                    "battle_time": battle_time,
-                    "result": result
-                }).execute()
-                # ---- СТРИК ----
-                recent_games = supabase.table("battles") \
-                    .select("result") \
-                    .eq("player_tag", tag) \
-                    .order("battle_time", desc=True) \
-                    .limit(20) \
-                    .execute().data
-                win_streak = 0
-                lose_streak = 0
-                for g in recent_games:
-                    if g["result"]:
-                        if lose_streak == 0:
-                            win_streak += 1
-                        else:
-                            break
-                    else:
-                        if win_streak == 0:
-                            lose_streak += 1
-                        else:
-                            break
-
-                streak_line = ""
-                meme_line = ""
-
-                if win_streak > 1:
-                    streak_line = f"🔥 Win streak: {win_streak}"
-                    meme_line = get_random_streak_message(win_streak, WIN_STREAK_MESSAGES)
-
-                elif lose_streak > 1:
-                    streak_line = f"💀 Lose streak: {lose_streak}"
-                    meme_line = get_random_streak_message(lose_streak, LOSE_STREAK_MESSAGES)
-                if random.random() < 0.03:
-                    meme_line = random.choice([
-                        "🤖 Бот подозревает использование чит-кодов",
-                        "👀 Supercell уже наблюдает",
-                        "🧠 IQ этой колоды явно выше среднего"
-                    ])
-                # ---- Средний gain за 10 ----
-                last_10 = supabase.table("battles") \
-                    .select("battle_time") \
-                    .eq("player_tag", tag) \
-                    .order("battle_time", desc=True) \
-                    .limit(10) \
-                    .execute().data
-
-                total_change = 0
-                count = 0
-
-                for g in last_10:
-                    matched = next(
-                        (b for b in battles if b["battleTime"] == g["battle_time"]),
-                        None
-                    )
-                    if matched:
-                        tc = matched["team"][0].get("trophyChange")
-                        if tc is not None:
-                            total_change += tc
-                            count += 1
-
-                avg_line = f"📊 Avg (10): {round(total_change/count,1)}" if count > 0 else ""
-
-                # ---- Формируем сообщение ----
-                try:
-                    player = battle["team"][0]
-                    opponent = battle["opponent"][0]
-
-                    player_name = player.get("name", "Unknown")
-                    opponent_name = opponent.get("name", "Unknown")
-                    player_name = player.get("name", "Unknown")
-                    opponent_name = opponent.get("name", "Unknown")
-                    player_trophies = battle["team"][0].get("startingTrophies", 0)
-                    opponent_trophies = battle["opponent"][0].get("startingTrophies", 0)
-
-                    # --- Проверяем ник в базе ---
-                    user_record = supabase.table("users") \
-                        .select("player_name") \
-                        .eq("daily_player_tag", tag) \
-                        .execute().data
-
-                    if user_record:
-                        stored_name = user_record[0]["player_name"]
-
-                        if stored_name != player_name:
-                            supabase.table("users") \
-                                .update({"player_name": player_name}) \
-                                .eq("daily_player_tag", tag) \
-                                .execute()
-                    player_crowns = player.get("crowns", 0)
-                    opponent_crowns = opponent.get("crowns", 0)
-                    special_line = ""
-
-                    if player_crowns == 3 and opponent_crowns == 0:
-                        special_line = random.choice(THREE_ZERO_MESSAGES)
-
-                    elif player_crowns == 0 and opponent_crowns == 3:
-                        special_line = random.choice(ZERO_THREE_MESSAGES)
-
-                    game_mode = battle.get("gameMode", {}).get("name")
-                    if game_mode:
-                        battle_mode_line = f"⚔ {game_mode}"
-                    else:
-                        battle_mode_line = f"⚔ {battle.get('type', 'Unknown')}"
-
-                    trophy_change = player.get("trophyChange")
-                    starting_trophies = player.get("startingTrophies")
-
-                    first_game_line = ""
-
-                    if is_first_game:
-                        if result:
-                            first_game_line = random.choice(FIRST_GAME_WIN)
-                        else:
-                            first_game_line = random.choice(FIRST_GAME_LOSE)
-
-                    if night_line:
-                        lines.append(night_line)
-
-                    trophy_line = ""
-                    trophies_total_line = ""
-
-                    if trophy_change is not None:
-                        if trophy_change > 0:
-                            trophy_line = f"📈 +{trophy_change} 🏆"
-                        elif trophy_change < 0:
-                            trophy_line = f"📉 {trophy_change} 🏆"
-                        else:
-                            trophy_line = "➖ 0 🏆"
-
-                        if starting_trophies is not None:
-                            current_trophies = starting_trophies + trophy_change
-                            trophies_total_line = f"🏆 Total: {current_trophies}"
-
-                    status_line = "🏆 <b>Victory</b>" if result else "❌ <b>Defeat</b>"
-
-                    lines = [
-                        status_line,
-                        "",
-                        f"👤 <b>{player_name}</b> ({player_trophies}🏆)",
-                        f"🆚 {opponent_name} ({opponent_trophies}🏆)",
-                        "",
-                        f"📊 {player_crowns} - {opponent_crowns}",
-                    ]
-
-                    if trophy_line:
-                        lines.append(trophy_line)
-                    if trophies_total_line:
-                        lines.append(trophies_total_line)
-                    if streak_line:
-                        lines.append(streak_line)
-                    if meme_line:
-                        lines.append(meme_line)
-                    if avg_line:
-                        lines.append(avg_line)
-                    if special_line:
-                        lines.append(special_line)
-                    if first_game_line:
-                        lines.append(first_game_line)
-
-                    lines.append(battle_mode_line)
-
-                    message = "\n".join(lines)
-
-                except Exception as e:
-                    logging.error(f"Battle message build error: {e}")
-                    continue
+        for row in storage.load_poll_times():
+            poll_times[row["player_tag"]] = datetime.fromisoformat(row["last_polled_at"])
+        poll_times_loaded = True
+
+def save_poll_times(tags, polled_at):
+    if not tags:
+        return
+    for tag in tags:
+        poll_times[tag] = polled_at
+    try:
+        storage.save_poll_times([
+            {
+                "player_tag": tag,
+                "last_polled_at": polled_at.isoformat()
+            }
+            for tag in tags
+        ])
+    except Exception as e:
+        logging.error(f"Poll times save error: {e}")
+
+def scan_priority(tag, now):
+    # ---- Дольше не опрашивали -> выше; вес за подписчиков и недавнюю активность ----
+    last_polled = poll_times.get(tag)
+    if last_polled is None:
+        return math.inf
+    weight = 1 + math.log2(1 + len(subscription_index.subscribers(tag)))
+    last_battle = battle_cursors.get(tag)
+    if last_battle is not None and now - last_battle < RECENT_ACTIVITY:
+        weight *= 2
+    return (now - last_polled).total_seconds() * weight
+
+def prioritize_tags(tags):
+    now = datetime.now(timezone.utc)
+    return sorted(tags, key=lambda tag: scan_priority(tag, now), reverse=True)
+
+# =============================
+# STREAKS / AVERAGES
+# =============================
+STREAK_LOOKBACK = 50
+AVG_WINDOW = 10
+# tag -> (won, length) текущей серии
+streaks = {}
+# tag -> RollingAverage изменений кубков
+trophy_averages = {}
+
+def drop_streak_state(tag):
+    streaks.pop(tag, None)
+    trophy_averages.pop(tag, None)
+
+def advance_streak(state, won):
+    last_won, length = state
+    if length and last_won == won:
+        return won, length + 1
+    return won, 1
+
+def load_battle_history(tag, before):
+    if tag in streaks and tag in trophy_averages:
+        return
+
+    # ---- Холодный старт: восстанавливаем серию и среднее из последних боёв ----
+    recent_games = storage.recent_battles(tag, before.isoformat(), STREAK_LOOKBACK)
+    state = (None, 0)
+    avg = RollingAverage(AVG_WINDOW)
+    for g in reversed(recent_games):
+        state = advance_streak(state, g["result"])
+        avg.push(g.get("trophy_change"))
+    streaks[tag] = state
+    trophy_averages[tag] = avg
+
+class RollingAverage:
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.total = 0
+        self.count = 0
+
+    def push(self, value):
+        if len(self.values) == self.values.maxlen:
+            dropped = self.values[0]
+            if dropped is not None:
+                self.total -= dropped
+                self.count -= 1
+        self.values.append(value)
+        if value is not None:
+            self.total += value
+            self.count += 1
+
+    def average(self):
+        if not self.count:
+            return None
+        return round(self.total / self.count, 1)
+
+def update_streak(tag, won):
+    state = advance_streak(streaks.get(tag, (None, 0)), won)
+    streaks[tag] = state
+    return state
+
+# =============================
+# DAILY ROLLUPS
+# =============================
+def empty_rollup(tag, day):
+    return {
+        "player_tag": tag,
+        "day": day.isoformat(),
+        "games": 0,
+        "wins": 0,
+        "losses": 0,
+        "crowns": 0,
+        "trophy_delta": 0,
+        "max_win_streak": 0,
+        "win_run": 0
+    }
+
+def add_to_rollup(rollup, result, crowns, trophy_change):
+    rollup["games"] += 1
+    if result:
+        rollup["wins"] += 1
+        rollup["win_run"] += 1
+        rollup["max_win_streak"] = max(rollup["max_win_streak"], rollup["win_run"])
+    else:
+        rollup["losses"] += 1
+        rollup["win_run"] = 0
+    rollup["crowns"] += crowns or 0
+    rollup["trophy_delta"] += trophy_change or 0
+
+def rollup_for(rollups, tag, day):
+    key = day.isoformat()
+    if key not in rollups:
+        rollups[key] = empty_rollup(tag, day)
+    return rollups[key]
+
+def save_rollups(rollups):
+    if not rollups:
+        return
+    storage.save_rollups(list(rollups.values()))
+
+def history_day(row):
+    return datetime.fromisoformat(row["battle_time"]).astimezone(timezone.utc).date()
+
+def rollups_from_history(tag, rows):
+    # ---- Сводки считаем из сохранённых боёв с нуля: повторный пересчёт даёт то же самое ----
+    rollups = {}
+    for row in rows:
+        add_to_rollup(rollup_for(rollups, tag, history_day(row)), row["result"], row.get("crowns"), row.get("trophy_change"))
+    return rollups
+
+def day_start(day):
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+def rebuild_rollups(tags=None):
+    # ---- Бэкфилл: пересчитываем сводки из сырых боёв ----
+    tags = tags or subscription_index.tags()
+    for tag in tags:
+        rows = storage.battle_history(tag)
+        rollups = rollups_from_history(tag, rows)
+        save_rollups(rollups)
+        logging.info(f"Rollups rebuilt for {tag}: {len(rows)} battles, {len(rollups)} days")
+
+# =============================
+# ALL-TIME TOTALS
+# =============================
+def count_totals(tag):
+    # ---- Счётчики из сырых боёв (два COUNT без выгрузки строк) ----
+    return {
+        "player_tag": tag,
+        "games": storage.count_battles(tag),
+        "wins": storage.count_battles(tag, wins_only=True)
+    }
+
+def reconcile_totals(tag):
+    # ---- Сверка (CLI и повтор тега после сбоя): перезаписывает счётчики пересчётом ----
+    totals = count_totals(tag)
+    storage.save_totals(totals)
+    return totals
+
+def get_totals(tag):
+    totals = storage.get_totals(tag)
+    if totals is None:
+        # ---- Первое обращение: только вставка, чужой инкремент не затираем ----
+        totals = count_totals(tag)
+        if not storage.create_totals(totals):
+            totals = storage.get_totals(tag)
+    return totals
+
+def add_to_totals(tag, games, wins):
+    # ---- Прибавляем в БД, а не пишем абсолют: вебхук может создавать строку параллельно ----
+    if storage.increment_totals(tag, games, wins):
+        return
+    # ---- Строки нет; новые бои уже сохранены, пересчёт их включает ----
+    if not storage.create_totals(count_totals(tag)):
+        # ---- Строку только что создал вебхук — до или после записи боёв, неизвестно ----
+        reconcile_totals(tag)
+
+def parse_battle_time(raw_time):
+    return datetime.strptime(
+        raw_time, "%Y%m%dT%H%M%S.%fZ"
+    ).replace(tzinfo=timezone.utc)
+
+def find_new_battles(tag, battles, cursor=None):
+    parsed = []
+    for battle in battles:
+        try:
+            parsed_time = parse_battle_time(battle["battleTime"])
+        except Exception:
+            continue
+        # ---- Лог отсортирован от новых к старым: дальше всё уже обработано ----
+        if cursor is not None and parsed_time <= cursor:
+            break
+        try:
+            result = battle["team"][0]["crowns"] > battle["opponent"][0]["crowns"]
+        except Exception:
+            continue
+        parsed.append((battle, parsed_time, result))
+
+    if not parsed or cursor is not None:
+        return parsed
+
+    # ---- Курсора нет: одним запросом берём уже сохранённые бои из окна лога ----
+    oldest = min(parsed_time for _, parsed_time, _ in parsed)
+    known = storage.battle_times_since(tag, oldest.isoformat())
+    known_times = {datetime.fromisoformat(battle_time) for battle_time in known}
+
+    return [item for item in parsed if item[1] not in known_times]
+
+def battle_row(tag, battle, parsed_time, result):
+    player = battle["team"][0]
+    opponent = battle["opponent"][0]
+    return {
+        "player_tag": tag,
+        "battle_time": parsed_time.isoformat(),
+        "result": result,
+        "trophy_change": player.get("trophyChange"),
+        "crowns": player.get("crowns"),
+        "opponent_crowns": opponent.get("crowns"),
+        "game_mode": battle.get("gameMode", {}).get("name") or battle.get("type"),
+        "starting_trophies": player.get("startingTrophies")
+    }
+
+def save_battles(tag, new_battles):
+    rows = [
+        battle_row(tag, battle, parsed_time, result)
+        for battle, parsed_time, result in new_battles
+    ]
+    return storage.save_battles(rows)
+
+def process_battle_log(tag, battles):
+    if not battles:
+        return 0
+    # ---- Ничего нового: пропускаем тег без запросов в БД ----
+    cursor = battle_cursors.get(tag)
+    newest = latest_battle_time(battles)
+    if newest is None or (cursor is not None and newest <= cursor):
+        return 0
+    new_battles = find_new_battles(tag, battles, cursor)
+    if not new_battles:
+        save_battle_cursor(tag, newest)
+        return 0
+    oldest_new = min(parsed_time for _, parsed_time, _ in new_battles)
+    load_battle_history(tag, oldest_new)
+    chronological = sorted(new_battles, key=lambda item: item[1])
+    # ---- Сначала бои: при повторе после сбоя уникальный ключ не даст вставить их дважды ----
+    inserted = save_battles(tag, new_battles)
+    # ---- Затронутые дни пересчитываем из battles, а не прибавляем: повтор идемпотентен ----
+    first_day = chronological[0][1].date()
+    last_day = chronological[-1][1].date()
+    history = storage.battle_history(
+        tag, day_start(first_day).isoformat(), day_start(last_day + timedelta(days=1)).isoformat()
+    )
+    rollups = rollups_from_history(tag, history)
+    first_games = {}
+    for row in history:
+        first_games.setdefault(history_day(row), datetime.fromisoformat(row["battle_time"]))
+    # ---- Сообщения копим и отправляем только после записи в БД ----
+    outgoing = []
+    # ---- Бэклог больше порога: состояние считаем по каждому бою, но шлём одну сводку ----
+    catch_up = CATCHUP_THRESHOLD > 0 and len(new_battles) > CATCHUP_THRESHOLD
+    # ---- Обрабатываем от старых к новым, чтобы стрик считался по порядку ----
+    for battle, parsed_time, result in chronological:
+        battle_hour = parsed_time.hour
+        is_first_game = first_games.get(parsed_time.date()) == parsed_time
+        is_night = battle_hour >= 0 and battle_hour < 6
+        night_line = ""
+        if is_night:
+            if result:
+                night_line = random.choice(NIGHT_WIN_MESSAGES)
+            else:
+                night_line = random.choice(NIGHT_LOSE_MESSAGES)
+        # ---- СТРИК ----
+        won, length = update_streak(tag, result)
+        win_streak = length if won else 0
+        lose_streak = 0 if won else length
+
+        streak_line = ""
+        meme_line = ""
+
+        if win_streak > 1:
+            streak_line = f"🔥 Win streak: {win_streak}"
+            meme_line = get_random_streak_message(win_streak, WIN_STREAK_MESSAGES)
+
+        elif lose_streak > 1:
+            streak_line = f"💀 Lose streak: {lose_streak}"
+            meme_line = get_random_streak_message(lose_streak, LOSE_STREAK_MESSAGES)
+        if random.random() < 0.03:
+            meme_line = random.choice([
+                "🤖 Бот подозревает использование чит-кодов",
+                "👀 Supercell уже наблюдает",
+                "🧠 IQ этой колоды явно выше среднего"
+            ])
+        # ---- Средний gain за последние бои ----
+        avg = trophy_averages.setdefault(tag, RollingAverage(AVG_WINDOW))
+        avg.push(battle["team"][0].get("trophyChange"))
+        avg_value = avg.average()
+        avg_line = f"📊 Avg ({AVG_WINDOW}): {avg_value}" if avg_value is not None else ""
+
+        if catch_up:
+            continue
+
+        # ---- Формируем сообщение ----
+        try:
+            player = battle["team"][0]
+            opponent = battle["opponent"][0]
+
+            player_name = player.get("name", "Unknown")
+            opponent_name = opponent.get("name", "Unknown")
+            player_name = player.get("name", "Unknown")
+            opponent_name = opponent.get("name", "Unknown")
+            player_trophies = battle["team"][0].get("startingTrophies", 0)
+            opponent_trophies = battle["opponent"][0].get("startingTrophies", 0)
+
+            # --- Проверяем ник в базе ---
+            stored_names = storage.daily_player_names(tag)
+
+            if stored_names:
+                stored_name = stored_names[0]
+
+                if stored_name != player_name:
+                    storage.update_daily_player_name(tag, player_name)
+            player_crowns = player.get("crowns", 0)
+            opponent_crowns = opponent.get("crowns", 0)
+            special_line = ""
+
+            if player_crowns == 3 and opponent_crowns == 0:
+                special_line = random.choice(THREE_ZERO_MESSAGES)
+
+            elif player_crowns == 0 and opponent_crowns == 3:
+                special_line = random.choice(ZERO_THREE_MESSAGES)
+
+            game_mode = battle.get("gameMode", {}).get("name")
+            if game_mode:
+                battle_mode_line = f"⚔ {game_mode}"
+            else:
+                battle_mode_line = f"⚔ {battle.get('type', 'Unknown')}"
+
+            trophy_change = player.get("trophyChange")
+            starting_trophies = player.get("startingTrophies")
+
+            first_game_line = ""
+
+            if is_first_game:
+                if result:
+                    first_game_line = random.choice(FIRST_GAME_WIN)
+                else:
+                    first_game_line = random.choice(FIRST_GAME_LOSE)
 
-                # ---- Отправляем ВСЕМ подписчикам ----
-                subscribers = [
-                    s["user_id"]
-                    for s in subscriptions
-                    if s["player_tag"] == tag
-                ]
+            trophy_line = ""
+            trophies_total_line = ""
 
-                for chat_id in subscribers:
-                    send_telegram(message, chat_id)
+            if trophy_change is not None:
+                if trophy_change > 0:
+                    trophy_line = f"📈 +{trophy_change} 🏆"
+                elif trophy_change < 0:
+                    trophy_line = f"📉 {trophy_change} 🏆"
+                else:
+                    trophy_line = "➖ 0 🏆"
+
+                if starting_trophies is not None:
+                    current_trophies = starting_trophies + trophy_change
+                    trophies_total_line = f"🏆 Total: {current_trophies}"
+
+            status_line = "🏆 <b>Victory</b>" if result else "❌ <b>Defeat</b>"
+
+            lines = [
+                status_line,
+                "",
+                f"👤 <b>{player_name}</b> ({player_trophies}🏆)",
+                f"🆚 {opponent_name} ({opponent_trophies}🏆)",
+                "",
+                f"📊 {player_crowns} - {opponent_crowns}",
+            ]
+
+            if trophy_line:
+                lines.append(trophy_line)
+            if trophies_total_line:
+                lines.append(trophies_total_line)
+            if streak_line:
+                lines.append(streak_line)
+            if meme_line:
+                lines.append(meme_line)
+            if avg_line:
+                lines.append(avg_line)
+            if special_line:
+                lines.append(special_line)
+            if first_game_line:
+                lines.append(first_game_line)
+            if night_line:
+                lines.append(night_line)
+
+            lines.append(battle_mode_line)
+
+            message = "\n".join(lines)
+
+        except Exception as e:
+            logging.error(f"Battle message build error: {e}")
+            continue
+
+        outgoing.append(message)
+
+    if catch_up:
+        digest = build_catch_up_digest(tag, chronological)
+        if digest:
+            outgoing.append(digest)
+
+    # ---- Курсор — последним: если что-то упадёт, тег повторится с тем же логом ----
+    save_rollups(rollups)
+    if len(inserted) == len(new_battles):
+        add_to_totals(tag, len(inserted), sum(1 for row in inserted if row["result"]))
+    else:
+        # ---- Часть боёв уже лежала в базе (повтор после сбоя): могли быть и прибавлены, ----
+        # ---- поэтому счётчики не инкрементируем, а пересчитываем из battles ----
+        reconcile_totals(tag)
+    save_battle_cursor(tag, newest)
+    NEW_BATTLES.inc(len(new_battles))
+
+    # ---- Отправляем ВСЕМ подписчикам ----
+    subscribers = subscription_index.subscribers(tag)
+    for message in outgoing:
+        for chat_id in subscribers:
+            send_telegram(message, chat_id)
+
+    return len(new_battles)
+
+def crown_margin(item):
+    battle, _, _ = item
+    player = battle["team"][0]
+    opponent = battle["opponent"][0]
+    return player.get("crowns", 0) - opponent.get("crowns", 0), player.get("trophyChange") or 0
+
+def digest_result_line(label, item):
+    battle, parsed_time, result = item
+    player = battle["team"][0]
+    opponent = battle["opponent"][0]
+    line = (
+        f"{label}: {'W' if result else 'L'} {player.get('crowns', 0)} - {opponent.get('crowns', 0)} "
+        f"vs {opponent.get('name', 'Unknown')}"
+    )
+    trophy_change = player.get("trophyChange")
+    if trophy_change is not None:
+        line += f" ({trophy_change:+d} 🏆)"
+    return line
+
+def build_catch_up_digest(tag, chronological):
+    try:
+        wins = sum(1 for _, _, result in chronological if result)
+        losses = len(chronological) - wins
+        winrate = round(wins / len(chronological) * 100, 1)
+        trophy_delta = sum(battle["team"][0].get("trophyChange") or 0 for battle, _, _ in chronological)
+
+        newest, _, _ = chronological[-1]
+        player = newest["team"][0]
+        player_name = player.get("name", "Unknown")
+
+        # --- Проверяем ник в базе (один раз на сводку) ---
+        stored_names = storage.daily_player_names(tag)
+        if stored_names and stored_names[0] != player_name:
+            storage.update_daily_player_name(tag, player_name)
+
+        if trophy_delta > 0:
+            trophy_line = f"📈 +{trophy_delta} 🏆"
+        elif trophy_delta < 0:
+            trophy_line = f"📉 {trophy_delta} 🏆"
+        else:
+            trophy_line = "➖ 0 🏆"
 
+        lines = [
+            f"📦 <b>Catch-up: {len(chronological)} battles</b>",
+            "",
+            f"👤 <b>{player_name}</b>",
+            f"🏆 {wins}W / ❌ {losses}L ({winrate}%)",
+            trophy_line
+        ]
+
+        starting_trophies = player.get("startingTrophies")
+        trophy_change = player.get("trophyChange")
+        if starting_trophies is not None and trophy_change is not None:
+            lines.append(f"🏆 Total: {starting_trophies + trophy_change}")
+
+        won, length = streaks.get(tag, (None, 0))
+        if length > 1:
+            lines.append(f"🔥 Win streak: {length}" if won else f"💀 Lose streak: {length}")
+
+        lines.append("")
+        lines.append(digest_result_line("🥇 Best", max(chronological, key=crown_margin)))
+        lines.append(digest_result_line("🥀 Worst", min(chronological, key=crown_margin)))
+
+        first_time = chronological[0][1]
+        last_time = chronological[-1][1]
+        lines.append(f"🕒 {first_time:%H:%M} – {last_time:%H:%M} UTC")
+
+        return "\n".join(lines)
+
+    except Exception as e:
+        logging.error(f"Catch-up digest build error: {e}")
+        return None
+
+def check_new_battles(tags=None, deadline=None):
+    # ---- tag -> сколько новых боёв нашлось; планировщик подстраивает по этому интервалы ----
+    # ---- deadline (monotonic): что не успели, остаётся самым «старым» и идёт первым в следующий раз ----
+    activity = {}
+    started_at = datetime.now(timezone.utc)
+    try:
+        # ---- Уникальные player_tag ----
+        unique_tags = cluster.filter(subscription_index.tags() if tags is None else tags)
+        if not unique_tags:
+            logging.info("No tracked players.")
+            return activity
+        load_battle_cursors()
+        load_poll_times()
+        for tag, battles in fetch_battle_logs(prioritize_tags(unique_tags), deadline):
+            # ---- Апстрим не ответил: тег не считается опрошенным ----
+            if battles is None:
+                continue
+            # ---- Аренда могла истечь за время прохода (например, БД недоступна) ----
+            if not cluster.owns(tag):
+                continue
+            # ---- Ошибка одного тега не должна останавливать весь проход ----
+            try:
+                activity[tag] = process_battle_log(tag, battles)
+            except Exception as e:
+                logging.error(f"{tag} | Battle check error: {e}")
+                # стрик и среднее уже сдвинуты в памяти: перечитаем из БД при повторе
+                drop_streak_state(tag)
+                continue
+            job_progress(tags_processed=1, battles_found=activity[tag])
+
+        if len(activity) < len(unique_tags):
+            logging.info(f"Partial pass: {len(activity)}/{len(unique_tags)} tags polled, rest deferred")
         logging.info("Battle check completed.")
 
     except Exception as e:
         logging.error(f"Battle check error: {e}")
+
+    save_poll_times(list(activity), started_at)
+
+    return activity
+def load_daily_rollups(tags, day):
+    # ---- Готовые сводки за день: одна строка на тег ----
+    rollups = {}
+    for row in storage.rollups_for_day(tags, day.isoformat()):
+        if row["games"]:
+            rollups[row["player_tag"]] = row
+    return rollups
+
+def mark_reports_sent(chat_ids, report_date):
+    if not chat_ids:
+        return
+    storage.mark_reported(chat_ids, str(report_date))
+
 def send_daily_reports():
     try:
         today = datetime.now(timezone.utc).date()
-        users = supabase.table("users") \
-            .select("id, daily_player_tag, player_name") \
-            .not_.is_("daily_player_tag", "null") \
-            .execute().data
+        users = storage.users_with_daily_tag()
         logging.info("Daily endpoint triggered")
 
 
@@ -410,40 +981,38 @@ def send_daily_reports():
             logging.info("No users with daily_player_tag.")
             return
 
-        start = datetime.combine(today - timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
-        end = datetime.combine(today, datetime.min.time(), tzinfo=timezone.utc)
-
-        for user in users:
+        # ---- Повторный запуск за ту же дату пропускает уже получивших отчёт ----
+        already_sent = storage.reported_users(str(today))
+        pending = [user for user in users if user["id"] not in already_sent]
+        logging.info(f"Daily reports: {len(pending)} of {len(users)} users pending")
+
+        tags = sorted({user["daily_player_tag"] for user in pending})
+        stats_by_tag = load_daily_rollups(tags, today - timedelta(days=1))
+        job_progress(tags_processed=len(tags))
+
+        batch = []
+        reported = 0
+
+        def flush(batch):
+            # ---- Сначала отмечаем в daily_report_log, потом ставим в очередь: ----
+            # ---- повторный /daily после сбоя не пришлёт дубль ----
+            mark_reports_sent([chat_id for chat_id, _, _ in batch], today)
+            for chat_id, gif, message in batch:
+                if gif:
+                    send_gif(chat_id, gif)
+                send_telegram(message, chat_id)
+            return len(batch)
+
+        for user in pending:
             chat_id = user["id"]
             tag = user["daily_player_tag"]
             name = user.get("player_name") or tag
 
-            # --- Получаем игры за вчера ---
-            response = supabase.table("battles") \
-                .select("result") \
-                .eq("player_tag", tag) \
-                .gte("battle_time", start.isoformat()) \
-                .lt("battle_time", end.isoformat()) \
-                .order("battle_time") \
-                .execute()
-
-            games = response.data
-            if not games:
+            stats = stats_by_tag.get(tag)
+            if not stats:
                 continue
 
-            total = len(games)
-            wins = sum(1 for g in games if g["result"])
-            losses = total - wins
-            winrate = round((wins / total) * 100, 1)
-
-            max_streak = 0
-            current = 0
-            for g in games:
-                if g["result"]:
-                    current += 1
-                    max_streak = max(max_streak, current)
-                else:
-                    current = 0
+            winrate = round((stats["wins"] / stats["games"]) * 100, 1)
             if winrate >= 65:
                 status, gif = random.choice(good_results)
 
@@ -453,160 +1022,1051 @@ def send_daily_reports():
             else:
                 status, gif = random.choice(mid_results)
 
-            if gif:
-                send_gif(chat_id, gif)
             message = (
                 f"📊 <b>Daily Report — {name}</b>\n\n"
-                f"🎮 Games: {total}\n"
-                f"🏆 Wins: {wins}\n"
-                f"❌ Losses: {losses}\n"
+                f"🎮 Games: {stats['games']}\n"
+                f"🏆 Wins: {stats['wins']}\n"
+                f"❌ Losses: {stats['losses']}\n"
                 f"📈 Winrate: {winrate}%\n"
-                f"🔥 Max streak: {max_streak}\n\n"
+                f"🔥 Max streak: {stats['max_win_streak']}\n\n"
                 f"{status}"
             )
 
-            send_telegram(message, chat_id)
-            supabase.table("daily_report_log").upsert(
-                {
-                    "user_id": chat_id,
-                    "report_date": str(today)
-                },
-                on_conflict="user_id,report_date"
-            ).execute()
-        logging.info("Daily reports sent successfully.")
+            batch.append((chat_id, gif, message))
+
+            if len(batch) >= DAILY_LOG_BATCH:
+                reported += flush(batch)
+                batch = []
+                logging.info(f"Daily reports: {reported}/{len(pending)} queued")
+
+        reported += flush(batch)
+        logging.info(f"Daily reports sent successfully: {reported} queued for {len(stats_by_tag)} players.")
 
     except Exception as e:
         logging.error(f"Daily report error: {e}")
 
-@app.route("/check", methods=["GET"])
-def run_check():
-    if check_lock.locked():
-        return "Already running", 200
+# =============================
+# JOBS
+# =============================
+JOB_HISTORY = 100
+# id -> job, последние JOB_HISTORY штук
+jobs = OrderedDict()
+# kind -> незавершённая задача этого типа
+active_jobs = {}
+jobs_lock = threading.Lock()
+job_context = threading.local()
+
+def job_progress(**deltas):
+    # ---- Счётчики текущей задачи потока; вне задачи ничего не делает ----
+    job = getattr(job_context, "job", None)
+    if job is None:
+        return
+    with jobs_lock:
+        for key, value in deltas.items():
+            job[key] += value
+
+def run_job(job, target):
+    job_context.job = job
+    with jobs_lock:
+        job["state"] = "running"
+        job["started"] = time.monotonic()
+    state, error = "done", None
+    try:
+        target()
+    except Exception as e:
+        logging.error(f"Job {job['id']} ({job['kind']}) failed: {e}")
+        state, error = "failed", str(e)
+    finally:
+        job_context.job = None
+    with jobs_lock:
+        job["state"] = state
+        job["error"] = error
+        job["finished"] = time.monotonic()
+        active_jobs.pop(job["kind"], None)
+
+def submit_job(kind, target):
+    # ---- Пока задача того же типа не завершилась, новые запросы получают её id ----
+    with jobs_lock:
+        job = active_jobs.get(kind)
+        if job is not None:
+            return job
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "kind": kind,
+            "state": "queued",
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "started": None,
+            "finished": None,
+            "tags_processed": 0,
+            "battles_found": 0,
+            "messages_queued": 0,
+            "error": None
+        }
+        jobs[job["id"]] = job
+        active_jobs[kind] = job
+        while len(jobs) > JOB_HISTORY:
+            jobs.popitem(last=False)
+    threading.Thread(target=run_job, args=(job, target), name=f"job-{kind}", daemon=True).start()
+    return job
+
+def job_status(job):
+    with jobs_lock:
+        status = {
+            key: job[key]
+            for key in ("id", "kind", "state", "created_at", "tags_processed",
+                        "battles_found", "messages_queued", "error")
+        }
+        started = job["started"]
+        finished = job["finished"] or time.monotonic()
+    status["elapsed"] = round(finished - started, 3) if started else 0.0
+    return status
 
-    with check_lock:
-        check_new_battles()
+def scan_deadline(budget=None):
+    budget = SCAN_BUDGET if budget is None else budget
+    return time.monotonic() + budget if budget > 0 else None
 
-    return "OK", 200
+def check_job(budget=None):
+    deadline = scan_deadline(budget)
+    with check_lock, CHECK_PASS_SECONDS.time():
+        activity = check_new_battles(deadline=deadline)
+    poll_scheduler.record(activity)
+
+@app.route("/check", methods=["GET"])
+def run_check():
+    budget = request.args.get("budget", type=float)
+    job = submit_job("check", lambda: check_job(budget))
+    return jsonify(job_status(job)), 202
 
 
 @app.route("/daily", methods=["GET"])
 def run_daily():
-    send_daily_reports()
-    return "Daily reports sent", 200
+    job = submit_job("daily", send_daily_reports)
+    return jsonify(job_status(job)), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job_status(job)), 200
 
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
+# =============================
+# RATE LIMITING
+# =============================
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class CircuitBreaker:
+    STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial = False
+        self.lock = threading.Lock()
+        BREAKER_STATE.labels(name).set(0)
+
+    def set_state(self, state):
+        if state != self.state:
+            logging.warning(f"Circuit {self.name}: {self.state} -> {state}")
+            self.state = state
+            BREAKER_STATE.labels(self.name).set(self.STATES[state])
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.set_state("half_open")
+                self.trial = False
+            # ---- half-open: пропускаем ровно один пробный запрос ----
+            if self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial = False
+            self.set_state("closed")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial = False
+                self.set_state("open")
+
+    def stats(self):
+        with self.lock:
+            retry_in = 0.0
+            if self.state == "open":
+                retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "retry_in": round(retry_in, 1)
+            }
+
+# =============================
+# CACHES
+# =============================
+class TTLCache:
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    CACHE_REQUESTS.labels(self.name, "hit").inc()
+                    return value
+                del self.data[key]
+            self.misses += 1
+            CACHE_REQUESTS.labels(self.name, "miss").inc()
+            return default
+
+    def peek(self, key):
+        # ---- Как get, но без учёта в hits/misses: вызывающий считает сам через count ----
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def count(self, result):
+        with self.lock:
+            if result == "hit":
+                self.hits += 1
+            elif result == "miss":
+                self.misses += 1
+        CACHE_REQUESTS.labels(self.name, result).inc()
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def prune(self):
+        # ---- Выкидываем протухшие записи, до которых больше никто не дотянется ----
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, (_, expires) in self.data.items() if expires is not None and expires <= now]:
+                del self.data[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.data),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+# =============================
+# HTTP SESSIONS
+# =============================
+def make_session(pool_size, headers=None):
+    # ---- Долгоживущие keep-alive соединения вместо нового TLS на каждый запрос ----
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+clash_session = make_session(
+    FETCH_WORKERS + 2,
+    {
+        "Authorization": f"Bearer {CR_TOKEN}",
+        "Accept": "application/json"
+    }
+)
+telegram_session = make_session(TG_WORKERS + 2)
+
+def clash_get(path, headers=None):
+    clash_limiter.acquire()
+    return clash_session.get(f"{CLASH_API_URL}{path}", headers=headers, timeout=CLASH_TIMEOUT)
+
+def telegram_post(method, timeout=None, **kwargs):
+    return telegram_session.post(
+        f"{TELEGRAM_API_URL}/bot{TG_TOKEN}/{method}",
+        timeout=timeout or TG_TIMEOUT,
+        **kwargs
+    )
+
 # =============================
 # TELEGRAM
 # =============================
-def send_telegram(message, chat_id):
-    try:
-        url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
+class TelegramDispatcher:
+    def __init__(self, workers, global_rate, chat_interval):
+        # ---- Один чат всегда попадает в одну очередь: порядок сообщений сохраняется ----
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.limiter = RateLimiter(global_rate)
+        self.chat_interval = chat_interval
+        self.lock = threading.Lock()
+        self.started = False
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            for i, q in enumerate(self.queues):
+                threading.Thread(
+                    target=self._run, args=(q,), name=f"tg-sender-{i}", daemon=True
+                ).start()
+            self.started = True
+
+    def submit(self, method, chat_id, data, files=None):
+        self.start()
+        with self.lock:
+            self.pending += 1
+        self.queues[hash(chat_id) % len(self.queues)].put((method, chat_id, data, files))
+        job_progress(messages_queued=1)
+
+    def depth(self):
+        with self.lock:
+            return self.pending
+
+    def drain(self):
+        for q in self.queues:
+            q.join()
+
+    def _run(self, q):
+        # ---- heap (ready_at, seq, chat_id) и FIFO на чат: пока один чат ждёт ----
+        # ---- интервал или ретрай, остальные чаты шарда отправляются ----
+        ready = []
+        chats = {}
+        next_allowed = {}
+        seq = itertools.count()
+
+        while True:
+            wait = None
+            if ready:
+                wait = max(0.0, ready[0][0] - time.monotonic())
+            if wait is None or wait > 0:
+                try:
+                    self._accept(q.get(timeout=wait), ready, chats, next_allowed, seq)
+                except queue.Empty:
+                    pass
+            # ---- Забираем всё, что уже лежит во входной очереди (не больше пачки) ----
+            for _ in range(256):
+                try:
+                    self._accept(q.get_nowait(), ready, chats, next_allowed, seq)
+                except queue.Empty:
+                    break
 
-        data = {
-            "chat_id": chat_id,
-            "text": message,
-            "parse_mode": "HTML"
-        }
+            if not ready or ready[0][0] > time.monotonic():
+                continue
 
-        requests.post(url, data=data, timeout=10)
+            _, _, chat_id = heapq.heappop(ready)
+            pending = chats[chat_id]
+            entry = pending[0]
+            method, data, files, attempt = entry
+            try:
+                outcome, retry_in = self._attempt(method, data, files, attempt)
+            except Exception as e:
+                logging.error(f"Telegram dispatcher error: {e}")
+                outcome, retry_in = "failed", None
+
+            now = time.monotonic()
+            if outcome == "retry":
+                entry[3] += 1
+                heapq.heappush(ready, (now + retry_in, next(seq), chat_id))
+                continue
 
-    except Exception as e:
-        logging.error(f"Telegram send error: {e}")
+            pending.popleft()
+            ok = outcome == "ok"
+            with self.lock:
+                self.pending -= 1
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+            (NOTIFICATIONS_SENT if ok else NOTIFICATIONS_FAILED).labels(method).inc()
+            q.task_done()
 
-def send_photo(chat_id, image_bytes):
-    try:
-        url = f"https://api.telegram.org/bot{TG_TOKEN}/sendPhoto"
-        files = {
-            "photo": ("graph.png", image_bytes)
-        }
-        data = {
-            "chat_id": chat_id
-        }
-        requests.post(url, data=data, files=files, timeout=20)
+            next_allowed[chat_id] = now + self.chat_interval
+            if pending:
+                heapq.heappush(ready, (next_allowed[chat_id], next(seq), chat_id))
+            else:
+                del chats[chat_id]
+            if len(next_allowed) > 1000:
+                next_allowed = {c: t for c, t in next_allowed.items() if t > now or c in chats}
+
+    def _accept(self, item, ready, chats, next_allowed, seq):
+        method, chat_id, data, files = item
+        pending = chats.get(chat_id)
+        if pending is not None:
+            pending.append([method, data, files, 1])
+            return
+        chats[chat_id] = deque([[method, data, files, 1]])
+        ready_at = max(time.monotonic(), next_allowed.get(chat_id, 0))
+        heapq.heappush(ready, (ready_at, next(seq), chat_id))
+
+    def _attempt(self, method, data, files, attempt):
+        # ---- Одна попытка: ("ok"|"failed", None) или ("retry", через сколько секунд) ----
+        timeout = TG_TIMEOUT if method == "sendMessage" else TG_UPLOAD_TIMEOUT
+        retry_in = None
+
+        self.limiter.acquire()
+        try:
+            with TELEGRAM_SEND_SECONDS.labels(method).time():
+                response = telegram_post(method, data=data, files=files, timeout=timeout)
+        except Exception as e:
+            logging.error(f"Telegram {method} error (attempt {attempt}): {e}")
+            retry_in = 2 ** attempt
+        else:
+            if response.status_code == 200:
+                return "ok", None
 
-    except Exception as e:
-        logging.error(f"Telegram photo send error: {e}")
+            if response.status_code == 429:
+                # ---- Telegram говорит сколько ждать ----
+                try:
+                    retry_in = response.json()["parameters"]["retry_after"]
+                except Exception:
+                    retry_in = 2 ** attempt
+                logging.warning(f"Telegram {method} rate limited, retry after {retry_in}s")
+            elif response.status_code >= 500:
+                retry_in = 2 ** attempt
+            else:
+                logging.error(f"Telegram {method} failed: {response.status_code} | {response.text}")
+                return "failed", None
 
-def send_gif(chat_id, gif_url):
-    try:
-        url = f"https://api.telegram.org/bot{TG_TOKEN}/sendAnimation"
+        if attempt >= TG_MAX_ATTEMPTS:
+            logging.error(f"Telegram {method} dropped after {TG_MAX_ATTEMPTS} attempts")
+            return "failed", None
+        return "retry", retry_in
 
-        data = {
-            "chat_id": chat_id,
-            "animation": gif_url
-        }
+telegram_dispatcher = TelegramDispatcher(TG_WORKERS, TG_GLOBAL_RATE, TG_CHAT_INTERVAL)
 
-        requests.post(url, data=data, timeout=20)
+def send_telegram(message, chat_id):
+    data = {
+        "chat_id": chat_id,
+        "text": message,
+        "parse_mode": "HTML"
+    }
+    telegram_dispatcher.submit("sendMessage", chat_id, data)
 
-    except Exception as e:
-        logging.error(f"GIF send error: {e}")
+def send_photo(chat_id, image_bytes):
+    if hasattr(image_bytes, "getvalue"):
+        image_bytes = image_bytes.getvalue()
+    files = {
+        "photo": ("graph.png", image_bytes)
+    }
+    data = {
+        "chat_id": chat_id
+    }
+    telegram_dispatcher.submit("sendPhoto", chat_id, data, files)
+
+def send_gif(chat_id, gif_url):
+    data = {
+        "chat_id": chat_id,
+        "animation": gif_url
+    }
+    telegram_dispatcher.submit("sendAnimation", chat_id, data)
 # =============================
 # CLASH API
 # =============================
+# ---- Общий лимит на proxy.royaleapi.dev ----
+clash_limiter = RateLimiter(CLASH_RATE_LIMIT)
+clash_breaker = CircuitBreaker("clash", CLASH_BREAKER_THRESHOLD, CLASH_BREAKER_RESET)
+
+class ClashUnavailable(Exception):
+    pass
+
+def clash_access_denied(response):
+    # ---- 403 accessDenied(.invalidIp) — отклонён ключ или IP, а не конкретный тег ----
+    if response.status_code != 403:
+        return False
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and str(body.get("reason", "")).startswith("accessDenied")
+
+def clash_request(path, headers=None):
+    # ---- 429/5xx/сетевые ошибки: ретраи с экспоненциальной паузой и full jitter ----
+    # ---- Открытый breaker отвечает сразу, не дожидаясь таймаутов ----
+    for attempt in range(CLASH_RETRIES + 1):
+        if not clash_breaker.allow():
+            raise ClashUnavailable("Clash API circuit is open")
+
+        retry_after = None
+        try:
+            response = clash_get(path, headers)
+        except requests.RequestException as e:
+            clash_breaker.record_failure()
+            if attempt == CLASH_RETRIES:
+                raise
+            logging.warning(f"Clash request failed: {e}, retry {attempt + 1}/{CLASH_RETRIES}")
+        else:
+            if clash_access_denied(response):
+                # ---- Ретраи ключ не починят, но breaker должен считать это отказом апстрима ----
+                clash_breaker.record_failure()
+                return response
+            if response.status_code != 429 and response.status_code < 500:
+                clash_breaker.record_success()
+                return response
+            clash_breaker.record_failure()
+            if attempt == CLASH_RETRIES:
+                return response
+            retry_after = response.headers.get("Retry-After")
+
+        CLASH_RETRIES_TOTAL.inc()
+        delay = random.uniform(0, CLASH_RETRY_BASE * 2 ** attempt)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        time.sleep(min(delay, CLASH_RETRY_MAX_DELAY))
+
+# =============================
+# TAG QUARANTINE
+# =============================
+# tag -> (подряд 404, monotonic до которого не опрашиваем)
+quarantined = {}
+quarantine_lock = threading.Lock()
+
+def is_quarantined(tag):
+    with quarantine_lock:
+        entry = quarantined.get(tag)
+    return entry is not None and entry[1] > time.monotonic()
+
+def record_tag_status(tag, status):
+    # ---- Несуществующий тег: после QUARANTINE_AFTER ответов 404 подряд паузы растут вдвое ----
+    # ---- 403 сюда не относится: это отказ ключу, его считает breaker ----
+    with quarantine_lock:
+        if status == 404:
+            strikes = quarantined.get(tag, (0, 0.0))[0] + 1
+            until = 0.0
+            if strikes >= QUARANTINE_AFTER:
+                delay = min(QUARANTINE_BASE * 2 ** min(strikes - QUARANTINE_AFTER, 20), QUARANTINE_MAX)
+                until = time.monotonic() + delay
+                logging.warning(f"{tag} quarantined for {int(delay)}s after {strikes} x {status}")
+            quarantined[tag] = (strikes, until)
+        elif status == 200:
+            quarantined.pop(tag, None)
+
+def quarantine_stats():
+    now = time.monotonic()
+    with quarantine_lock:
+        return sum(1 for _, until in quarantined.values() if until > now)
+
+def cache_lifetime(headers, default_ttl):
+    # ---- Cache-Control важнее нашего TTL; None = не хранить вовсе ----
+    directives = {}
+    for part in headers.get("Cache-Control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('"')
+
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    try:
+        return float(directives["max-age"])
+    except (KeyError, ValueError):
+        return default_ttl
+
+
+class ClashResponseCache:
+    def __init__(self, maxsize):
+        # path -> {"data", "etag", "expires"}; протухшие записи с ETag держим ради If-None-Match
+        self.entries = TTLCache("clash_responses", maxsize)
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.pruned_at = time.monotonic()
+
+    def fetch(self, path, ttl=0):
+        # ---- hit — только свежая запись; протухшая считается в request как revalidated или miss ----
+        entry = self.entries.peek(path)
+        if entry is not None and entry["expires"] > time.monotonic():
+            self.entries.count("hit")
+            return 200, entry["data"]
+
+        # ---- Один запрос в апстрим на path, остальные ждут его результат ----
+        with self.lock:
+            future = self.inflight.get(path)
+            leader = future is None
+            if leader:
+                future = self.inflight[path] = Future()
+
+        if not leader:
+            CACHE_REQUESTS.labels(self.entries.name, "coalesced").inc()
+            return future.result()
+
+        try:
+            result = self.request(path, ttl, entry)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[path]
+
+    def request(self, path, ttl, entry):
+        headers = None
+        if entry is not None and entry["etag"]:
+            headers = {"If-None-Match": entry["etag"]}
+
+        response = clash_request(path, headers)
+
+        if response.status_code == 304 and entry is not None:
+            self.entries.count("revalidated")
+            self.store(path, entry["data"], entry["etag"], cache_lifetime(response.headers, ttl))
+            return 200, entry["data"]
+        self.entries.count("miss")
+
+        if response.status_code != 200:
+            return response.status_code, response.text
+
+        data = response.json()
+        self.store(path, data, response.headers.get("ETag"), cache_lifetime(response.headers, ttl))
+        return 200, data
+
+    def store(self, path, data, etag, lifetime):
+        if lifetime is None or (lifetime <= 0 and not etag):
+            self.entries.pop(path)
+            return
+        now = time.monotonic()
+        # ---- Без ETag протухшую запись не ревалидировать: пусть уходит вместе с max-age ----
+        self.entries.set(path, {
+            "data": data,
+            "etag": etag,
+            "expires": now + lifetime
+        }, ttl=None if etag else lifetime)
+        # ---- Протухшие записи без ETag, которые больше не запрашивают, чистим раз в минуту ----
+        if now - self.pruned_at > 60:
+            self.pruned_at = now
+            self.entries.prune()
+
+clash_responses = ClashResponseCache(CLASH_CACHE_SIZE)
+
 def get_battle_log(player_tag):
+    # ---- [] — тег опрошен (пусть и без боёв), None — апстрим недоступен, повторить позже ----
+    if is_quarantined(player_tag):
+        return []
+
+    started = time.perf_counter()
+    outcome = "error"
     try:
         tag = player_tag.replace("#", "")
-        url = f"https://proxy.royaleapi.dev/v1/players/%23{tag}/battlelog"
-        headers = {"Authorization": f"Bearer {CR_TOKEN}"}  # ← добавить
-        response = requests.get(url, headers=headers, timeout=10)
+        status, data = clash_responses.fetch(f"/players/%23{tag}/battlelog")
+
+        logging.info(f"RESPONSE → {status}")
+        record_tag_status(player_tag, status)
 
-        logging.info(f"RESPONSE → {response.status_code}")
+        if status == 200:
+            outcome = "ok"
+            return data
 
-        if response.status_code == 200:
-            return response.json()
+        logging.error(f"{player_tag} | Proxy error: {status} | {data}")
+        if status == 404:
+            outcome = "not_found"
+            return []
+        outcome = "access_denied" if status == 403 else "http_error"
 
-        logging.error(f"{player_tag} | Proxy error: {response.status_code} | {response.text}")
+    except ClashUnavailable:
+        outcome = "circuit_open"
 
     except Exception as e:
         logging.error(f"Proxy request failed: {e}")
 
-    return []
+    finally:
+        BATTLELOG_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+    return None
+
+def fetch_battle_logs(tags, deadline=None):
+    # ---- Качаем логи параллельно, отдаём по мере готовности ----
+    # ---- В полёте не больше FETCH_WORKERS: порядок тегов соблюдается, после дедлайна новые не берём ----
+    pending = iter(tags)
+    futures = {}
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        def fill():
+            while len(futures) < FETCH_WORKERS:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                tag = next(pending, None)
+                if tag is None:
+                    return
+                futures[pool.submit(get_battle_log, tag)] = tag
+
+        fill()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield futures.pop(future), future.result()
+            fill()
+# =============================
+# POLL SCHEDULER
+# =============================
+class PollScheduler:
+    def __init__(self, min_interval, max_interval, backoff):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # heap из (due, tag); устаревшие записи отбрасываем сверкой с self.due
+        self.heap = []
+        self.due = {}
+        self.intervals = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="poll-scheduler", daemon=True)
+            self.thread.start()
+
+    def schedule(self, tag, interval):
+        # ---- ±10% разброса, чтобы теги не сбивались в одну волну ----
+        due = time.monotonic() + interval * random.uniform(0.9, 1.1)
+        self.intervals[tag] = interval
+        self.due[tag] = due
+        heapq.heappush(self.heap, (due, tag))
+
+    def sync(self, tags):
+        # ---- Новые подписки опрашиваем сразу, отписанные забываем ----
+        tags = set(tags)
+        now = time.monotonic()
+        with self.lock:
+            for tag in tags - self.due.keys():
+                self.due[tag] = now
+                self.intervals[tag] = self.min_interval
+                heapq.heappush(self.heap, (now, tag))
+            for tag in self.due.keys() - tags:
+                del self.due[tag]
+                del self.intervals[tag]
+
+    def pop_due(self):
+        now = time.monotonic()
+        tags = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                due, tag = heapq.heappop(self.heap)
+                if self.due.get(tag) == due:
+                    tags.append(tag)
+        return tags
+
+    def record(self, activity):
+        # ---- Новый бой -> минимальный интервал, тишина -> удваиваем до потолка ----
+        with self.lock:
+            for tag, new_battles in activity.items():
+                interval = self.intervals.get(tag)
+                if interval is None:
+                    continue
+                if new_battles:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * self.backoff, self.max_interval)
+                self.schedule(tag, interval)
+        self.wakeup.set()
+
+    def defer(self, tags):
+        with self.lock:
+            for tag in tags:
+                interval = self.intervals.get(tag)
+                if interval is not None:
+                    self.schedule(tag, self.min_interval)
+                    self.intervals[tag] = interval
+
+    def next_wait(self):
+        with self.lock:
+            if not self.heap:
+                return self.min_interval
+            return max(0.0, min(self.heap[0][0] - time.monotonic(), self.min_interval))
+
+    def stats(self):
+        with self.lock:
+            intervals = sorted(self.intervals.values())
+        if not intervals:
+            return {"tags": 0}
+        return {
+            "tags": len(intervals),
+            "active": sum(1 for interval in intervals if interval <= self.min_interval),
+            "median_interval": intervals[len(intervals) // 2],
+            "max_interval": intervals[-1]
+        }
+
+    def _run(self):
+        while True:
+            try:
+                self.sync(cluster.filter(subscription_index.tags()))
+                tags = self.pop_due()
+                if tags:
+                    with check_lock, SCHEDULER_BATCH_SECONDS.time():
+                        activity = check_new_battles(tags, scan_deadline())
+                    self.record(activity)
+                    # ---- Не успели в бюджет или проход упал: повторим скоро, интервал не трогаем ----
+                    self.defer([tag for tag in tags if tag not in activity])
+            except Exception as e:
+                logging.error(f"Poll scheduler error: {e}")
+            self.wakeup.wait(self.next_wait())
+            self.wakeup.clear()
+
+poll_scheduler = PollScheduler(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_BACKOFF)
+
+# =============================
+# CLUSTER
+# =============================
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+def utc_stamp(moment):
+    # ---- Один формат везде: строки сравниваются лексикографически ----
+    return moment.isoformat(timespec="seconds")
+
+def forget_tag_state(tag):
+    # ---- Тег вёл другой инстанс: локальные курсор и стрик устарели ----
+    battle_cursors.pop(tag, None)
+    poll_times.pop(tag, None)
+    drop_streak_state(tag)
+
+class ClusterMembership:
+    def __init__(self, enabled, instance_id, heartbeat_interval, lease_ttl, vnodes):
+        self.enabled = enabled
+        self.instance_id = instance_id
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_ttl = lease_ttl
+        self.vnodes = vnodes
+        self.members = []
+        # отсортированные (hash, instance_id) виртуальных узлов
+        self.ring = []
+        self.leased = set()
+        self.valid_until = 0.0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if not self.enabled or self.thread is not None:
+            return
+        if not self.instance_id:
+            # ---- После fork у каждого gunicorn-воркера свой id ----
+            self.instance_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        try:
+            self.refresh()
+        except Exception as e:
+            logging.error(f"Cluster join error: {e}")
+        self.thread = threading.Thread(target=self._run, name="cluster-heartbeat", daemon=True)
+        self.thread.start()
+        atexit.register(self.leave)
+
+    def owner(self, tag):
+        if not self.ring:
+            return None
+        i = bisect.bisect(self.ring, (ring_hash(tag), ""))
+        return self.ring[i % len(self.ring)][1]
+
+    def owns(self, tag):
+        if not self.enabled:
+            return True
+        with self.lock:
+            return tag in self.leased and time.monotonic() < self.valid_until
+
+    def filter(self, tags):
+        if not self.enabled:
+            return tags
+        with self.lock:
+            if time.monotonic() >= self.valid_until:
+                return []
+            return [tag for tag in tags if tag in self.leased]
+
+    def refresh(self):
+        now = datetime.now(timezone.utc)
+        storage.heartbeat(self.instance_id, utc_stamp(now))
+
+        # ---- Живые = слали heartbeat за последние три интервала ----
+        alive_since = now - timedelta(seconds=self.heartbeat_interval * 3)
+        members = sorted(set(storage.live_instances(utc_stamp(alive_since))) | {self.instance_id})
+        if members != self.members:
+            logging.info(f"Cluster members changed: {len(members)} ({', '.join(members)})")
+            self.ring = sorted(
+                (ring_hash(f"{member}#{i}"), member)
+                for member in members
+                for i in range(self.vnodes)
+            )
+            self.members = members
+
+        assigned = {tag for tag in subscription_index.tags() if self.owner(tag) == self.instance_id}
+        with self.lock:
+            held = set(self.leased)
+
+        # ---- Отдаём теги только между проходами, иначе новый владелец начнёт параллельно ----
+        released = held - assigned
+        if released and check_lock.acquire(blocking=False):
+            try:
+                with self.lock:
+                    self.leased -= released
+                storage.release_leases(sorted(released), self.instance_id)
+                logging.info(f"Released {len(released)} tags to other instances")
+            finally:
+                check_lock.release()
+            held -= released
+
+        # ---- Продлеваем свои аренды и забираем новые (свободные или протухшие) ----
+        started = time.monotonic()
+        expires = now + timedelta(seconds=self.lease_ttl)
+        claimed = set(storage.claim_leases(
+            sorted(assigned | held), self.instance_id, utc_stamp(now), utc_stamp(expires)
+        ))
+        with self.lock:
+            acquired = claimed - self.leased
+            for tag in acquired:
+                forget_tag_state(tag)
+            self.leased = claimed
+            self.valid_until = started + self.lease_ttl - self.heartbeat_interval
+        if acquired:
+            logging.info(f"Acquired {len(acquired)} tags")
+
+    def leave(self):
+        with self.lock:
+            leased = sorted(self.leased)
+            self.leased = set()
+        try:
+            storage.release_leases(leased, self.instance_id)
+            storage.remove_instance(self.instance_id)
+        except Exception as e:
+            logging.error(f"Cluster leave error: {e}")
+
+    def stats(self):
+        with self.lock:
+            leased = len(self.leased)
+        return {
+            "enabled": self.enabled,
+            "instance_id": self.instance_id,
+            "members": len(self.members),
+            "leased_tags": leased
+        }
+
+    def _run(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"Cluster heartbeat error: {e}")
+
+cluster = ClusterMembership(CLUSTER_MODE, INSTANCE_ID, HEARTBEAT_INTERVAL, LEASE_TTL, CLUSTER_VNODES)
+
 # ============================
 # GRAPH BUILD
 # ============================
+graph_cache = TTLCache("graph", GRAPH_CACHE_SIZE)
+graph_pool = None
+graph_pool_lock = threading.Lock()
+
+def render_graph(tag, games, rates):
+    global graph_pool
+    # ---- main.py запущен как скрипт: spawn-воркер выполнил бы всё тело main заново ----
+    # ---- (хранилище, сессии, метрики), поэтому без run.py рисуем в текущем процессе ----
+    if GRAPH_PROCESSES <= 0 or __name__ == "__main__":
+        return render_winrate_png(tag, games, rates)
+
+    with graph_pool_lock:
+        if graph_pool is None:
+            graph_pool = ProcessPoolExecutor(
+                max_workers=GRAPH_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        # ---- Локальная ссылка: параллельный обработчик BrokenProcessPool может обнулить глобальную ----
+        pool = graph_pool
+    try:
+        return pool.submit(render_winrate_png, tag, games, rates).result(timeout=GRAPH_RENDER_TIMEOUT)
+    except BrokenProcessPool as e:
+        # ---- Пул умер: пересоздадим при следующем рендере, этот рисуем сами ----
+        logging.error(f"Graph pool error: {e}")
+        with graph_pool_lock:
+            if graph_pool is pool:
+                graph_pool = None
+        return render_winrate_png(tag, games, rates)
+
 def send_winrate_graph(chat_id, tag, last_n=None):
     try:
         tag = tag.upper()
 
-        response = supabase.table("battles") \
-            .select("result, battle_time") \
-            .eq("player_tag", tag) \
-            .order("battle_time", desc=False) \
-            .execute()
-
-        games = response.data
+        latest = storage.latest_battle_time(tag)
 
-        if not games:
+        if not latest:
             send_telegram("No games to build graph.", chat_id)
             return
 
-        if last_n:
-            games = games[-last_n:]
-
-        cumulative_rates = []
-        wins = 0
-
-        for i, g in enumerate(games, start=1):
-            if g["result"] == True:
-                wins += 1
-            cumulative_rates.append((wins / i) * 100)
+        # ---- Пока не появилось новых боёв, картинка та же ----
+        cache_key = (tag, last_n, latest)
+        image = graph_cache.get(cache_key)
+        if image is None:
+            # ---- Тянем только нужные строки и только колонку result ----
+            if last_n:
+                results = storage.recent_results(tag, last_n)
+            else:
+                results = storage.all_results(tag)
 
-        plt.figure()
-        plt.plot(range(1, len(cumulative_rates) + 1), cumulative_rates)
-        plt.xlabel("Games")
-        plt.ylabel("Winrate %")
-        plt.title(f"Winrate progression for {tag}")
-        plt.ylim(0, 100)
+            games, rates = winrate_series(results)
+            games, rates = downsample_lttb(games, rates, GRAPH_MAX_POINTS)
 
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format="png")
-        plt.close()
-        buffer.seek(0)
+            image = render_graph(tag, games, rates)
+            graph_cache.set(cache_key, image)
 
-        send_photo(chat_id, buffer)
+        send_photo(chat_id, image)
 
     except Exception as e:
         logging.error(f"Graph error: {e}")
@@ -616,34 +2076,23 @@ def calculate_winrate(chat_id, tag, last_n=None):
     try:
         tag = tag.upper()
 
-        subscription = supabase.table("user_players") \
-            .select("id") \
-            .eq("user_id", chat_id) \
-            .eq("player_tag", tag) \
-            .execute()
-
-        if not subscription.data:
+        if not is_tracking(chat_id, tag):
             send_telegram("❌ You are not tracking this player.", chat_id)
             return
 
-        query = supabase.table("battles") \
-            .select("result") \
-            .eq("player_tag", tag) \
-            .order("battle_time", desc=True)
-
         if last_n:
-            query = query.range(0, last_n - 1)
-
-        response = query.execute()
-        games = response.data
-
-        total = len(games)
+            results = storage.recent_results(tag, last_n)
+            total = len(results)
+            wins = sum(1 for r in results if r is True)
+        else:
+            totals = get_totals(tag)
+            total = totals["games"]
+            wins = totals["wins"]
 
         if total == 0:
             send_telegram("No games yet.", chat_id)
             return
 
-        wins = sum(1 for g in games if g["result"] is True)
         rate = round((wins / total) * 100, 1)
 
         title = f"Last {total} games" if last_n else "All games"
@@ -683,30 +2132,17 @@ def handle_message(message):
 
             tag = parts[1].upper()
 
-            existing = supabase.table("user_players") \
-                .select("*") \
-                .eq("user_id", chat_id) \
-                .eq("player_tag", tag) \
-                .execute()
-
-            if existing.data:
+            if storage.has_subscription(chat_id, tag):
                 send_telegram(f"⚠ {tag} already added.", chat_id)
                 return
 
-            supabase.table("user_players").insert({
-                "user_id": chat_id,
-                "player_tag": tag
-            }).execute()
+            storage.add_subscription(chat_id, tag)
+            subscription_index.add(chat_id, tag)
 
             send_telegram(f"✅ Added {tag}", chat_id)
 
         elif command == "/list":
-            response = supabase.table("user_players") \
-                .select("player_tag") \
-                .eq("user_id", chat_id) \
-                .execute()
-
-            players = [p["player_tag"] for p in response.data]
+            players = storage.user_tags(chat_id)
 
             send_telegram(
                 "📋 Your players:\n" + ("\n".join(players) if players else "No players added"),
@@ -749,24 +2185,12 @@ def handle_message(message):
                 return
 
             tag = parts[1].upper()
-            exists = supabase.table("user_players") \
-                .select("id") \
-                .eq("user_id", chat_id) \
-                .eq("player_tag", tag) \
-                .execute()
-
-            if not exists.data:
+            if not is_tracking(chat_id, tag):
                 send_telegram("❌ You are not tracking this player. Use /add first.", chat_id)
                 return
             player_name = get_player_name(tag)
 
-            supabase.table("users") \
-                .update({
-                    "daily_player_tag": tag,
-                    "player_name": player_name
-                }) \
-                .eq("id", chat_id) \
-                .execute()
+            storage.set_daily_player(chat_id, tag, player_name)
             display = player_name if player_name else tag
             send_telegram(f"✅ Daily report set for {display}", chat_id)
 
@@ -777,11 +2201,8 @@ def handle_message(message):
 
             tag = parts[1].upper()
 
-            supabase.table("user_players") \
-                .delete() \
-                .eq("user_id", chat_id) \
-                .eq("player_tag", tag) \
-                .execute()
+            storage.remove_subscription(chat_id, tag)
+            subscription_index.remove(chat_id, tag)
 
             send_telegram(f"🗑 Removed {tag}", chat_id)
 
@@ -818,8 +2239,8 @@ def send_webapp_button(chat_id, tag):
         ]]
     }
 
-    requests.post(
-        f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage",
+    telegram_post(
+        "sendMessage",
         json={
             "chat_id": chat_id,
             "text": f"Interactive stats for {tag}",
@@ -827,28 +2248,122 @@ def send_webapp_button(chat_id, tag):
         }
     )
 
+known_users = TTLCache("known_users", KNOWN_USERS_CACHE_SIZE, KNOWN_USERS_TTL)
+
 def register_user(chat_id, username=None):
+    if known_users.get(chat_id):
+        return
     try:
-        existing = supabase.table("users").select("id").eq("id", chat_id).execute()
-
-        if not existing.data:
-            supabase.table("users").insert({
-                "id": chat_id,
-                "username": username
-            }).execute()
+        # ---- Промах кэша: идемпотентно создаём пользователя, существующего не трогаем ----
+        storage.ensure_user(chat_id, username)
+        known_users.set(chat_id, True)
     except Exception as e:
         logging.error(f"Register user error: {e}")
+# =============================
+# WEBHOOK
+# =============================
+webhook_pool = ThreadPoolExecutor(max_workers=WEBHOOK_WORKERS, thread_name_prefix="webhook")
+webhook_pending = 0
+webhook_pending_lock = threading.Lock()
+recent_updates = OrderedDict()
+recent_updates_lock = threading.Lock()
+
+def remember_update(update_id):
+    with recent_updates_lock:
+        if update_id in recent_updates:
+            return False
+        recent_updates[update_id] = True
+        if len(recent_updates) > UPDATE_DEDUP_WINDOW:
+            recent_updates.popitem(last=False)
+        return True
+
+def forget_update(update_id):
+    with recent_updates_lock:
+        recent_updates.pop(update_id, None)
+
+def reserve_webhook_slot():
+    global webhook_pending
+    # ---- Сколько апдейтов может быть в работе + в очереди одновременно ----
+    with webhook_pending_lock:
+        if webhook_pending >= WEBHOOK_WORKERS + WEBHOOK_QUEUE_LIMIT:
+            return False
+        webhook_pending += 1
+        return True
+
+def release_webhook_slot():
+    global webhook_pending
+    with webhook_pending_lock:
+        webhook_pending -= 1
+
+def process_update(data):
+    try:
+        if "message" in data:
+            handle_message(data["message"])
+    except Exception as e:
+        logging.error(f"Update processing error: {e}")
+    finally:
+        release_webhook_slot()
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    data = request.json
-    if "message" in data:
-        handle_message(data["message"])
+    data = request.get_json(silent=True) or {}
+    update_id = data.get("update_id")
+
+    # ---- Telegram повторяет медленные апдейты: дубли отбрасываем ----
+    if update_id is not None and not remember_update(update_id):
+        return "ok", 200
+
+    if not reserve_webhook_slot():
+        # ---- Пул забит: пусть Telegram пришлёт апдейт позже ----
+        if update_id is not None:
+            forget_update(update_id)
+        logging.warning(f"Webhook saturated, shedding update {update_id}")
+        return "busy", 503
+
+    webhook_pool.submit(process_update, data)
     return "ok", 200
 
+@app.route("/metrics")
+def metrics():
+    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+@app.route("/status")
+def status():
+    return jsonify({
+        "telegram_queue": telegram_dispatcher.depth(),
+        "telegram_sent": telegram_dispatcher.sent,
+        "telegram_failed": telegram_dispatcher.failed,
+        "webhook_pending": webhook_pending,
+        "known_users_cache": known_users.stats(),
+        "clash_response_cache": clash_responses.entries.stats(),
+        "poll_scheduler": poll_scheduler.stats(),
+        "cluster": cluster.stats(),
+        "clash_breaker": clash_breaker.stats(),
+        "quarantined_tags": quarantine_stats(),
+        "graph_cache": graph_cache.stats()
+    }), 200
+
 @app.route("/")
 def home():
     return "Bot is running", 200
 
+def start_background_workers():
+    # ---- Под gunicorn вызывать из post_fork: потоки не переживают fork ----
+    cluster.start()
+    if SCHEDULER_ENABLED:
+        poll_scheduler.start()
+
+def run(args):
+    # ---- Точка входа: python Backend/run.py [команда] ----
+    if args and args[0] == "backfill-rollups":
+        rebuild_rollups(args[1:] or None)
+    elif args and args[0] == "reconcile-totals":
+        for tag in args[1:] or subscription_index.tags():
+            reconcile_totals(tag)
+    else:
+        start_background_workers()
+        port = int(os.environ.get("PORT", 10000))
+        app.run(host="0.0.0.0", port=port)
+
 if __name__ == "__main__":
-    port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    run(sys.argv[1:])
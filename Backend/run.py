@@ -0,0 +1,7 @@
+import sys
+
+# ---- Импорты только под guard: spawn-воркеры пула графиков перезапускают этот скрипт ----
+# ---- как __mp_main__, и тело main (хранилище, сессии, метрики) в них выполняться не должно ----
+if __name__ == "__main__":
+    import main
+    main.run(sys.argv[1:])
@@ -0,0 +1,923 @@
+import time
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+
+IN_CHUNK = 100
+PAGE_SIZE = 1000
+
+ROLLUP_COLUMNS = ("player_tag", "day", "games", "wins", "losses", "crowns",
+                  "trophy_delta", "max_win_streak", "win_run")
+BATTLE_COLUMNS = ("player_tag", "battle_time", "result", "trophy_change", "crowns",
+                  "opponent_crowns", "game_mode", "starting_trophies")
+
+# ---- Метод хранилища -> (таблица, операция) для метрик ----
+TABLE_OPERATIONS = {
+    "ensure_user": ("users", "upsert"),
+    "users_with_daily_tag": ("users", "select"),
+    "set_daily_player": ("users", "update"),
+    "daily_player_names": ("users", "select"),
+    "update_daily_player_name": ("users", "update"),
+    "all_subscriptions": ("user_players", "select"),
+    "user_tags": ("user_players", "select"),
+    "has_subscription": ("user_players", "select"),
+    "add_subscription": ("user_players", "insert"),
+    "remove_subscription": ("user_players", "delete"),
+    "save_battles": ("battles", "upsert"),
+    "battle_times_since": ("battles", "select"),
+    "recent_battles": ("battles", "select"),
+    "latest_battle_time": ("battles", "select"),
+    "recent_results": ("battles", "select"),
+    "all_results": ("battles", "select"),
+    "battle_history": ("battles", "select"),
+    "count_battles": ("battles", "count"),
+    "load_cursors": ("player_cursors", "select"),
+    "save_cursor": ("player_cursors", "upsert"),
+    "load_poll_times": ("player_polls", "select"),
+    "save_poll_times": ("player_polls", "upsert"),
+    "load_rollups": ("daily_rollups", "select"),
+    "rollups_for_day": ("daily_rollups", "select"),
+    "save_rollups": ("daily_rollups", "upsert"),
+    "get_totals": ("player_totals", "select"),
+    "save_totals": ("player_totals", "upsert"),
+    "create_totals": ("player_totals", "insert"),
+    "increment_totals": ("player_totals", "update"),
+    "reported_users": ("daily_report_log", "select"),
+    "mark_reported": ("daily_report_log", "upsert"),
+    "heartbeat": ("instances", "upsert"),
+    "live_instances": ("instances", "select"),
+    "remove_instance": ("instances", "delete"),
+    "claim_leases": ("tag_leases", "upsert"),
+    "release_leases": ("tag_leases", "delete"),
+}
+
+
+# =============================
+# INTERFACE
+# =============================
+class Storage(ABC):
+    # ---- Бэкенд без какого-либо метода падает при создании, а не посреди прохода ----
+    # ---- users ----
+    @abstractmethod
+    def ensure_user(self, chat_id, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def users_with_daily_tag(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_daily_player(self, chat_id, tag, player_name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def daily_player_names(self, tag):
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_daily_player_name(self, tag, player_name):
+        raise NotImplementedError
+
+    # ---- user_players ----
+    @abstractmethod
+    def all_subscriptions(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def user_tags(self, chat_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def has_subscription(self, chat_id, tag):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_subscription(self, chat_id, tag):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_subscription(self, chat_id, tag):
+        raise NotImplementedError
+
+    # ---- battles ----
+    @abstractmethod
+    def save_battles(self, rows):
+        raise NotImplementedError
+
+    @abstractmethod
+    def battle_times_since(self, tag, since):
+        raise NotImplementedError
+
+    @abstractmethod
+    def recent_battles(self, tag, before, limit):
+        raise NotImplementedError
+
+    @abstractmethod
+    def latest_battle_time(self, tag):
+        raise NotImplementedError
+
+    @abstractmethod
+    def recent_results(self, tag, limit):
+        raise NotImplementedError
+
+    @abstractmethod
+    def all_results(self, tag):
+        raise NotImplementedError
+
+    @abstractmethod
+    def battle_history(self, tag, since=None, until=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_battles(self, tag, wins_only=False):
+        raise NotImplementedError
+
+    # ---- player_cursors ----
+    @abstractmethod
+    def load_cursors(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_cursor(self, tag, battle_time):
+        raise NotImplementedError
+
+    # ---- player_polls ----
+    @abstractmethod
+    def load_poll_times(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_poll_times(self, rows):
+        raise NotImplementedError
+
+    # ---- daily_rollups ----
+    @abstractmethod
+    def load_rollups(self, tag, days):
+        raise NotImplementedError
+
+    @abstractmethod
+    def rollups_for_day(self, tags, day):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_rollups(self, rows):
+        raise NotImplementedError
+
+    # ---- player_totals ----
+    @abstractmethod
+    def get_totals(self, tag):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_totals(self, row):
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_totals(self, row):
+        raise NotImplementedError
+
+    @abstractmethod
+    def increment_totals(self, tag, games, wins):
+        raise NotImplementedError
+
+    # ---- daily_report_log ----
+    @abstractmethod
+    def reported_users(self, report_date):
+        raise NotImplementedError
+
+    @abstractmethod
+    def mark_reported(self, chat_ids, report_date):
+        raise NotImplementedError
+
+    # ---- instances / tag_leases ----
+    @abstractmethod
+    def heartbeat(self, instance_id, seen_at):
+        raise NotImplementedError
+
+    @abstractmethod
+    def live_instances(self, since):
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_instance(self, instance_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_leases(self, tags, owner, now, expires_at):
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_leases(self, tags, owner):
+        raise NotImplementedError
+
+
+# =============================
+# SUPABASE
+# =============================
+class SupabaseStorage(Storage):
+    def __init__(self, url, key):
+        from supabase import create_client
+        self.client = create_client(url, key)
+
+    def table(self, name):
+        return self.client.table(name)
+
+    def fetch_all(self, build_query):
+        # ---- PostgREST отдаёт максимум 1000 строк, читаем страницами ----
+        rows = []
+        start = 0
+        while True:
+            page = build_query().range(start, start + PAGE_SIZE - 1).execute().data
+            rows.extend(page)
+            if len(page) < PAGE_SIZE:
+                return rows
+            start += PAGE_SIZE
+
+    def ensure_user(self, chat_id, username):
+        self.table("users").upsert(
+            {
+                "id": chat_id,
+                "username": username
+            },
+            on_conflict="id",
+            ignore_duplicates=True
+        ).execute()
+
+    def users_with_daily_tag(self):
+        return self.fetch_all(lambda: self.table("users")
+                              .select("id, daily_player_tag, player_name")
+                              .not_.is_("daily_player_tag", "null")
+                              .order("id"))
+
+    def set_daily_player(self, chat_id, tag, player_name):
+        self.table("users") \
+            .update({
+                "daily_player_tag": tag,
+                "player_name": player_name
+            }) \
+            .eq("id", chat_id) \
+            .execute()
+
+    def daily_player_names(self, tag):
+        rows = self.table("users") \
+            .select("player_name") \
+            .eq("daily_player_tag", tag) \
+            .execute().data
+        return [row["player_name"] for row in rows]
+
+    def update_daily_player_name(self, tag, player_name):
+        self.table("users") \
+            .update({"player_name": player_name}) \
+            .eq("daily_player_tag", tag) \
+            .execute()
+
+    def all_subscriptions(self):
+        return self.fetch_all(lambda: self.table("user_players")
+                              .select("user_id, player_tag")
+                              .order("id"))
+
+    def user_tags(self, chat_id):
+        rows = self.table("user_players") \
+            .select("player_tag") \
+            .eq("user_id", chat_id) \
+            .execute().data
+        return [row["player_tag"] for row in rows]
+
+    def has_subscription(self, chat_id, tag):
+        rows = self.table("user_players") \
+            .select("id") \
+            .eq("user_id", chat_id) \
+            .eq("player_tag", tag) \
+            .execute().data
+        return bool(rows)
+
+    def add_subscription(self, chat_id, tag):
+        self.table("user_players").insert({
+            "user_id": chat_id,
+            "player_tag": tag
+        }).execute()
+
+    def remove_subscription(self, chat_id, tag):
+        self.table("user_players") \
+            .delete() \
+            .eq("user_id", chat_id) \
+            .eq("player_tag", tag) \
+            .execute()
+
+    def save_battles(self, rows):
+        # ---- С ignore_duplicates PostgREST возвращает только вставленные строки ----
+        return self.table("battles").upsert(
+            rows,
+            on_conflict="player_tag,battle_time",
+            ignore_duplicates=True
+        ).execute().data
+
+    def battle_times_since(self, tag, since):
+        rows = self.table("battles") \
+            .select("battle_time") \
+            .eq("player_tag", tag) \
+            .gte("battle_time", since) \
+            .execute().data
+        return [row["battle_time"] for row in rows]
+
+    def recent_battles(self, tag, before, limit):
+        return self.table("battles") \
+            .select("result, trophy_change") \
+            .eq("player_tag", tag) \
+            .lt("battle_time", before) \
+            .order("battle_time", desc=True) \
+            .limit(limit) \
+            .execute().data
+
+    def latest_battle_time(self, tag):
+        rows = self.table("battles") \
+            .select("battle_time") \
+            .eq("player_tag", tag) \
+            .order("battle_time", desc=True) \
+            .limit(1) \
+            .execute().data
+        return rows[0]["battle_time"] if rows else None
+
+    def recent_results(self, tag, limit):
+        rows = self.table("battles") \
+            .select("result") \
+            .eq("player_tag", tag) \
+            .order("battle_time", desc=True) \
+            .limit(limit) \
+            .execute().data
+        return [row["result"] for row in reversed(rows)]
+
+    def all_results(self, tag):
+        rows = self.fetch_all(lambda: self.table("battles")
+                              .select("result")
+                              .eq("player_tag", tag)
+                              .order("battle_time"))
+        return [row["result"] for row in rows]
+
+    def battle_history(self, tag, since=None, until=None):
+        def build():
+            query = self.table("battles") \
+                .select("battle_time, result, crowns, trophy_change") \
+                .eq("player_tag", tag)
+            if since is not None:
+                query = query.gte("battle_time", since)
+            if until is not None:
+                query = query.lt("battle_time", until)
+            return query.order("battle_time")
+        return self.fetch_all(build)
+
+    def count_battles(self, tag, wins_only=False):
+        query = self.table("battles") \
+            .select("id", count="exact", head=True) \
+            .eq("player_tag", tag)
+        if wins_only:
+            query = query.eq("result", True)
+        return query.execute().count or 0
+
+    def load_cursors(self):
+        return self.fetch_all(lambda: self.table("player_cursors")
+                              .select("player_tag, last_battle_time")
+                              .order("player_tag"))
+
+    def save_cursor(self, tag, battle_time):
+        self.table("player_cursors").upsert(
+            {
+                "player_tag": tag,
+                "last_battle_time": battle_time
+            },
+            on_conflict="player_tag"
+        ).execute()
+
+    def load_poll_times(self):
+        return self.fetch_all(lambda: self.table("player_polls")
+                              .select("player_tag, last_polled_at")
+                              .order("player_tag"))
+
+    def save_poll_times(self, rows):
+        for i in range(0, len(rows), 500):
+            self.table("player_polls").upsert(
+                rows[i:i + 500],
+                on_conflict="player_tag"
+            ).execute()
+
+    def load_rollups(self, tag, days):
+        return self.table("daily_rollups") \
+            .select(", ".join(ROLLUP_COLUMNS)) \
+            .eq("player_tag", tag) \
+            .in_("day", sorted(days)) \
+            .execute().data
+
+    def rollups_for_day(self, tags, day):
+        rows = []
+        for i in range(0, len(tags), IN_CHUNK):
+            chunk = tags[i:i + IN_CHUNK]
+            rows.extend(self.fetch_all(lambda: self.table("daily_rollups")
+                                       .select(", ".join(ROLLUP_COLUMNS))
+                                       .in_("player_tag", chunk)
+                                       .eq("day", day)
+                                       .order("player_tag")))
+        return rows
+
+    def save_rollups(self, rows):
+        for i in range(0, len(rows), 500):
+            self.table("daily_rollups").upsert(
+                rows[i:i + 500],
+                on_conflict="player_tag,day"
+            ).execute()
+
+    def get_totals(self, tag):
+        rows = self.table("player_totals") \
+            .select("player_tag, games, wins") \
+            .eq("player_tag", tag) \
+            .execute().data
+        return rows[0] if rows else None
+
+    def save_totals(self, row):
+        self.table("player_totals").upsert(row, on_conflict="player_tag").execute()
+
+    def create_totals(self, row):
+        # ---- Вставка только если строки нет; True, если вставили мы ----
+        rows = self.table("player_totals") \
+            .upsert(row, on_conflict="player_tag", ignore_duplicates=True) \
+            .execute().data
+        return bool(rows)
+
+    def increment_totals(self, tag, games, wins):
+        # ---- Прибавление на стороне БД (функция increment_player_totals), False — строки нет ----
+        found = self.client.rpc(
+            "increment_player_totals",
+            {"p_tag": tag, "p_games": games, "p_wins": wins}
+        ).execute().data
+        return bool(found)
+
+    def reported_users(self, report_date):
+        rows = self.fetch_all(lambda: self.table("daily_report_log")
+                              .select("user_id")
+                              .eq("report_date", report_date)
+                              .order("user_id"))
+        return {row["user_id"] for row in rows}
+
+    def mark_reported(self, chat_ids, report_date):
+        self.table("daily_report_log").upsert(
+            [
+                {
+                    "user_id": chat_id,
+                    "report_date": report_date
+                }
+                for chat_id in chat_ids
+            ],
+            on_conflict="user_id,report_date"
+        ).execute()
+
+    def heartbeat(self, instance_id, seen_at):
+        self.table("instances").upsert(
+            {
+                "instance_id": instance_id,
+                "heartbeat_at": seen_at
+            },
+            on_conflict="instance_id"
+        ).execute()
+
+    def live_instances(self, since):
+        rows = self.table("instances") \
+            .select("instance_id") \
+            .gte("heartbeat_at", since) \
+            .execute().data
+        return [row["instance_id"] for row in rows]
+
+    def remove_instance(self, instance_id):
+        self.table("instances").delete().eq("instance_id", instance_id).execute()
+
+    def claim_leases(self, tags, owner, now, expires_at):
+        claimed = set()
+        for i in range(0, len(tags), IN_CHUNK):
+            chunk = tags[i:i + IN_CHUNK]
+            # ---- Свободные теги: вставка, чужие строки не трогаем ----
+            inserted = self.table("tag_leases").upsert(
+                [
+                    {
+                        "player_tag": tag,
+                        "owner": owner,
+                        "expires_at": expires_at
+                    }
+                    for tag in chunk
+                ],
+                on_conflict="player_tag",
+                ignore_duplicates=True
+            ).execute().data
+            # ---- Свои и протухшие: условие UPDATE перепроверяется под блокировкой строки ----
+            updated = self.table("tag_leases") \
+                .update({"owner": owner, "expires_at": expires_at}) \
+                .in_("player_tag", chunk) \
+                .or_(f'owner.eq."{owner}",expires_at.lt."{now}"') \
+                .execute().data
+            claimed.update(row["player_tag"] for row in inserted + updated)
+        return sorted(claimed)
+
+    def release_leases(self, tags, owner):
+        for i in range(0, len(tags), IN_CHUNK):
+            self.table("tag_leases") \
+                .delete() \
+                .eq("owner", owner) \
+                .in_("player_tag", tags[i:i + IN_CHUNK]) \
+                .execute()
+
+
+# =============================
+# SQLITE
+# =============================
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    daily_player_tag TEXT,
+    player_name TEXT
+);
+CREATE INDEX IF NOT EXISTS users_daily_player_tag ON users (daily_player_tag);
+
+CREATE TABLE IF NOT EXISTS user_players (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    player_tag TEXT NOT NULL,
+    UNIQUE (user_id, player_tag)
+);
+CREATE INDEX IF NOT EXISTS user_players_player_tag ON user_players (player_tag);
+
+CREATE TABLE IF NOT EXISTS battles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    player_tag TEXT NOT NULL,
+    battle_time TEXT NOT NULL,
+    result INTEGER NOT NULL,
+    trophy_change INTEGER,
+    crowns INTEGER,
+    opponent_crowns INTEGER,
+    game_mode TEXT,
+    starting_trophies INTEGER,
+    UNIQUE (player_tag, battle_time)
+);
+
+CREATE TABLE IF NOT EXISTS player_cursors (
+    player_tag TEXT PRIMARY KEY,
+    last_battle_time TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS player_polls (
+    player_tag TEXT PRIMARY KEY,
+    last_polled_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    player_tag TEXT NOT NULL,
+    day TEXT NOT NULL,
+    games INTEGER NOT NULL,
+    wins INTEGER NOT NULL,
+    losses INTEGER NOT NULL,
+    crowns INTEGER NOT NULL,
+    trophy_delta INTEGER NOT NULL,
+    max_win_streak INTEGER NOT NULL,
+    win_run INTEGER NOT NULL,
+    PRIMARY KEY (player_tag, day)
+);
+CREATE INDEX IF NOT EXISTS daily_rollups_day ON daily_rollups (day);
+
+CREATE TABLE IF NOT EXISTS player_totals (
+    player_tag TEXT PRIMARY KEY,
+    games INTEGER NOT NULL,
+    wins INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS daily_report_log (
+    user_id INTEGER NOT NULL,
+    report_date TEXT NOT NULL,
+    PRIMARY KEY (user_id, report_date)
+);
+
+CREATE TABLE IF NOT EXISTS instances (
+    instance_id TEXT PRIMARY KEY,
+    heartbeat_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tag_leases (
+    player_tag TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tag_leases_owner ON tag_leases (owner);
+"""
+
+# ---- Постоянные строки запросов: sqlite3 кэширует их скомпилированными ----
+SQL_INSERT_BATTLE = (
+    f"INSERT OR IGNORE INTO battles ({', '.join(BATTLE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in BATTLE_COLUMNS)})"
+)
+SQL_CLAIM_LEASE = (
+    "INSERT INTO tag_leases (player_tag, owner, expires_at) VALUES (?, ?, ?) "
+    "ON CONFLICT (player_tag) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+    "WHERE tag_leases.owner = excluded.owner OR tag_leases.expires_at < ?"
+)
+SQL_UPSERT_ROLLUP = (
+    f"INSERT OR REPLACE INTO daily_rollups ({', '.join(ROLLUP_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in ROLLUP_COLUMNS)})"
+)
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        with self.write_lock:
+            self.conn().executescript(SQLITE_SCHEMA)
+
+    def conn(self):
+        # ---- Своё соединение на поток; WAL даёт читать параллельно с записью ----
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self.local.conn = conn
+        return conn
+
+    def query(self, sql, params=()):
+        return [dict(row) for row in self.conn().execute(sql, params)]
+
+    def write(self, sql, params=()):
+        with self.write_lock:
+            return self.conn().execute(sql, params).rowcount
+
+    def write_many(self, sql, rows):
+        if not rows:
+            return
+        with self.write_lock:
+            conn = self.conn()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(sql, rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def ensure_user(self, chat_id, username):
+        self.write("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)", (chat_id, username))
+
+    def users_with_daily_tag(self):
+        return self.query(
+            "SELECT id, daily_player_tag, player_name FROM users "
+            "WHERE daily_player_tag IS NOT NULL ORDER BY id"
+        )
+
+    def set_daily_player(self, chat_id, tag, player_name):
+        self.write(
+            "UPDATE users SET daily_player_tag = ?, player_name = ? WHERE id = ?",
+            (tag, player_name, chat_id)
+        )
+
+    def daily_player_names(self, tag):
+        rows = self.query("SELECT player_name FROM users WHERE daily_player_tag = ?", (tag,))
+        return [row["player_name"] for row in rows]
+
+    def update_daily_player_name(self, tag, player_name):
+        self.write("UPDATE users SET player_name = ? WHERE daily_player_tag = ?", (player_name, tag))
+
+    def all_subscriptions(self):
+        return self.query("SELECT user_id, player_tag FROM user_players ORDER BY id")
+
+    def user_tags(self, chat_id):
+        rows = self.query("SELECT player_tag FROM user_players WHERE user_id = ? ORDER BY id", (chat_id,))
+        return [row["player_tag"] for row in rows]
+
+    def has_subscription(self, chat_id, tag):
+        rows = self.query(
+            "SELECT 1 FROM user_players WHERE user_id = ? AND player_tag = ? LIMIT 1",
+            (chat_id, tag)
+        )
+        return bool(rows)
+
+    def add_subscription(self, chat_id, tag):
+        self.write(
+            "INSERT OR IGNORE INTO user_players (user_id, player_tag) VALUES (?, ?)",
+            (chat_id, tag)
+        )
+
+    def remove_subscription(self, chat_id, tag):
+        self.write("DELETE FROM user_players WHERE user_id = ? AND player_tag = ?", (chat_id, tag))
+
+    def save_battles(self, rows):
+        # ---- Возвращаем только вставленные строки: дубликаты INSERT OR IGNORE пропускает ----
+        inserted = []
+        if not rows:
+            return inserted
+        with self.write_lock:
+            conn = self.conn()
+            conn.execute("BEGIN")
+            try:
+                for row in rows:
+                    if conn.execute(SQL_INSERT_BATTLE, tuple(row[c] for c in BATTLE_COLUMNS)).rowcount:
+                        inserted.append(row)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return inserted
+
+    def battle_times_since(self, tag, since):
+        rows = self.query(
+            "SELECT battle_time FROM battles WHERE player_tag = ? AND battle_time >= ?",
+            (tag, since)
+        )
+        return [row["battle_time"] for row in rows]
+
+    def recent_battles(self, tag, before, limit):
+        rows = self.query(
+            "SELECT result, trophy_change FROM battles "
+            "WHERE player_tag = ? AND battle_time < ? ORDER BY battle_time DESC LIMIT ?",
+            (tag, before, limit)
+        )
+        for row in rows:
+            row["result"] = bool(row["result"])
+        return rows
+
+    def latest_battle_time(self, tag):
+        rows = self.query(
+            "SELECT battle_time FROM battles WHERE player_tag = ? ORDER BY battle_time DESC LIMIT 1",
+            (tag,)
+        )
+        return rows[0]["battle_time"] if rows else None
+
+    def recent_results(self, tag, limit):
+        rows = self.query(
+            "SELECT result FROM battles WHERE player_tag = ? ORDER BY battle_time DESC LIMIT ?",
+            (tag, limit)
+        )
+        return [bool(row["result"]) for row in reversed(rows)]
+
+    def all_results(self, tag):
+        rows = self.conn().execute(
+            "SELECT result FROM battles WHERE player_tag = ? ORDER BY battle_time",
+            (tag,)
+        )
+        return [bool(row[0]) for row in rows]
+
+    def battle_history(self, tag, since=None, until=None):
+        sql = "SELECT battle_time, result, crowns, trophy_change FROM battles WHERE player_tag = ?"
+        params = [tag]
+        if since is not None:
+            sql += " AND battle_time >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND battle_time < ?"
+            params.append(until)
+        rows = self.query(sql + " ORDER BY battle_time", params)
+        for row in rows:
+            row["result"] = bool(row["result"])
+        return rows
+
+    def count_battles(self, tag, wins_only=False):
+        sql = "SELECT COUNT(*) FROM battles WHERE player_tag = ?"
+        if wins_only:
+            sql += " AND result = 1"
+        return self.conn().execute(sql, (tag,)).fetchone()[0]
+
+    def load_cursors(self):
+        return self.query("SELECT player_tag, last_battle_time FROM player_cursors ORDER BY player_tag")
+
+    def save_cursor(self, tag, battle_time):
+        self.write(
+            "INSERT OR REPLACE INTO player_cursors (player_tag, last_battle_time) VALUES (?, ?)",
+            (tag, battle_time)
+        )
+
+    def load_poll_times(self):
+        return self.query("SELECT player_tag, last_polled_at FROM player_polls ORDER BY player_tag")
+
+    def save_poll_times(self, rows):
+        self.write_many(
+            "INSERT OR REPLACE INTO player_polls (player_tag, last_polled_at) VALUES (?, ?)",
+            [(row["player_tag"], row["last_polled_at"]) for row in rows]
+        )
+
+    def load_rollups(self, tag, days):
+        days = sorted(days)
+        if not days:
+            return []
+        return self.query(
+            f"SELECT {', '.join(ROLLUP_COLUMNS)} FROM daily_rollups "
+            f"WHERE player_tag = ? AND day IN ({', '.join('?' for _ in days)})",
+            (tag, *days)
+        )
+
+    def rollups_for_day(self, tags, day):
+        rows = []
+        for i in range(0, len(tags), IN_CHUNK):
+            chunk = tags[i:i + IN_CHUNK]
+            rows.extend(self.query(
+                f"SELECT {', '.join(ROLLUP_COLUMNS)} FROM daily_rollups "
+                f"WHERE day = ? AND player_tag IN ({', '.join('?' for _ in chunk)}) "
+                f"ORDER BY player_tag",
+                (day, *chunk)
+            ))
+        return rows
+
+    def save_rollups(self, rows):
+        self.write_many(SQL_UPSERT_ROLLUP, [tuple(row[c] for c in ROLLUP_COLUMNS) for row in rows])
+
+    def get_totals(self, tag):
+        rows = self.query("SELECT player_tag, games, wins FROM player_totals WHERE player_tag = ?", (tag,))
+        return rows[0] if rows else None
+
+    def save_totals(self, row):
+        self.write(
+            "INSERT OR REPLACE INTO player_totals (player_tag, games, wins) VALUES (?, ?, ?)",
+            (row["player_tag"], row["games"], row["wins"])
+        )
+
+    def create_totals(self, row):
+        return self.write(
+            "INSERT OR IGNORE INTO player_totals (player_tag, games, wins) VALUES (?, ?, ?)",
+            (row["player_tag"], row["games"], row["wins"])
+        ) > 0
+
+    def increment_totals(self, tag, games, wins):
+        return self.write(
+            "UPDATE player_totals SET games = games + ?, wins = wins + ? WHERE player_tag = ?",
+            (games, wins, tag)
+        ) > 0
+
+    def reported_users(self, report_date):
+        rows = self.query("SELECT user_id FROM daily_report_log WHERE report_date = ?", (report_date,))
+        return {row["user_id"] for row in rows}
+
+    def mark_reported(self, chat_ids, report_date):
+        self.write_many(
+            "INSERT OR IGNORE INTO daily_report_log (user_id, report_date) VALUES (?, ?)",
+            [(chat_id, report_date) for chat_id in chat_ids]
+        )
+
+    def heartbeat(self, instance_id, seen_at):
+        self.write(
+            "INSERT OR REPLACE INTO instances (instance_id, heartbeat_at) VALUES (?, ?)",
+            (instance_id, seen_at)
+        )
+
+    def live_instances(self, since):
+        rows = self.query("SELECT instance_id FROM instances WHERE heartbeat_at >= ?", (since,))
+        return [row["instance_id"] for row in rows]
+
+    def remove_instance(self, instance_id):
+        self.write("DELETE FROM instances WHERE instance_id = ?", (instance_id,))
+
+    def claim_leases(self, tags, owner, now, expires_at):
+        self.write_many(SQL_CLAIM_LEASE, [(tag, owner, expires_at, now) for tag in tags])
+        claimed = []
+        for i in range(0, len(tags), IN_CHUNK):
+            chunk = tags[i:i + IN_CHUNK]
+            rows = self.query(
+                f"SELECT player_tag FROM tag_leases "
+                f"WHERE owner = ? AND player_tag IN ({', '.join('?' for _ in chunk)})",
+                (owner, *chunk)
+            )
+            claimed.extend(row["player_tag"] for row in rows)
+        return sorted(claimed)
+
+    def release_leases(self, tags, owner):
+        for i in range(0, len(tags), IN_CHUNK):
+            chunk = tags[i:i + IN_CHUNK]
+            self.write(
+                f"DELETE FROM tag_leases WHERE owner = ? AND player_tag IN ({', '.join('?' for _ in chunk)})",
+                (owner, *chunk)
+            )
+
+
+# =============================
+# INSTRUMENTATION
+# =============================
+class InstrumentedStorage:
+    def __init__(self, storage, observe):
+        self.storage = storage
+        self.observe = observe
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name not in TABLE_OPERATIONS:
+            return attr
+        table, operation = TABLE_OPERATIONS[name]
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.observe(table, operation, time.perf_counter() - started)
+        return timed
+
+
+def create_storage(backend, supabase_url=None, supabase_key=None, sqlite_path=None):
+    if backend == "sqlite":
+        return SQLiteStorage(sqlite_path)
+    if backend == "supabase":
+        return SupabaseStorage(supabase_url, supabase_key)
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+# ---- main создаёт хранилище при импорте: SQLite во временной папке, без сети ----
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "import.db")
+os.environ["SCHEDULER_ENABLED"] = "0"
+os.environ["CLUSTER_MODE"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from storage import SQLiteStorage
+
+START = datetime(2026, 10, 16, 12, 0, tzinfo=timezone.utc)
+
+
+def make_battle(minute, won, trophy_change=30, name="Player"):
+    return {
+        "battleTime": (START + timedelta(minutes=minute)).strftime("%Y%m%dT%H%M%S.000Z"),
+        "type": "PvP",
+        "gameMode": {"name": "Ladder"},
+        "team": [{
+            "name": name,
+            "crowns": 3 if won else 1,
+            "trophyChange": trophy_change if won else -trophy_change,
+            "startingTrophies": 7000
+        }],
+        "opponent": [{"name": "Opponent", "crowns": 1 if won else 3, "startingTrophies": 7000}]
+    }
+
+
+def make_log(results):
+    # ---- Как в Clash API: самый новый бой первым ----
+    return [make_battle(minute, won) for minute, won in reversed(list(enumerate(results)))]
+
+
+@pytest.fixture
+def sqlite_storage(tmp_path):
+    return SQLiteStorage(str(tmp_path / "bot.db"))
+
+
+@pytest.fixture
+def bot(sqlite_storage, monkeypatch):
+    # ---- Свежая база и пустое состояние процесса ----
+    monkeypatch.setattr(main, "storage", sqlite_storage)
+    monkeypatch.setattr(main, "battle_cursors", {})
+    monkeypatch.setattr(main, "streaks", {})
+    monkeypatch.setattr(main, "trophy_averages", {})
+    monkeypatch.setattr(main, "subscription_index", main.SubscriptionIndex(3600))
+    return main
+
+
+@pytest.fixture
+def sent(bot, monkeypatch):
+    # ---- Вместо Telegram копим (chat_id, message) ----
+    messages = []
+    monkeypatch.setattr(bot, "send_telegram", lambda message, chat_id: messages.append((chat_id, message)))
+    return messages
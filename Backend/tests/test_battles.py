@@ -0,0 +1,94 @@
+import pytest
+
+from conftest import make_log
+
+
+def subscribe(bot, chat_id, tag):
+    bot.storage.add_subscription(chat_id, tag)
+
+
+def test_new_battles_notify_every_subscriber_once(bot, sent):
+    subscribe(bot, 1, "#A")
+    subscribe(bot, 2, "#A")
+    log = make_log([True, True, False])
+
+    assert bot.process_battle_log("#A", log) == 3
+    assert len(sent) == 6
+    assert sorted({chat_id for chat_id, _ in sent}) == [1, 2]
+    assert sum("Victory" in message for _, message in sent) == 4
+
+    # ---- Тот же лог повторно: ничего нового ----
+    assert bot.process_battle_log("#A", log) == 0
+    assert len(sent) == 6
+
+    assert bot.storage.count_battles("#A") == 3
+    assert bot.get_totals("#A") == {"player_tag": "#A", "games": 3, "wins": 2}
+    rollup = bot.storage.load_rollups("#A", ["2026-10-16"])[0]
+    assert (rollup["games"], rollup["wins"], rollup["max_win_streak"]) == (3, 2, 2)
+
+
+def test_backlog_sends_one_digest(bot, sent, monkeypatch):
+    monkeypatch.setattr(bot, "CATCHUP_THRESHOLD", 3)
+    subscribe(bot, 1, "#A")
+
+    assert bot.process_battle_log("#A", make_log([True, False, True, True, True])) == 5
+    assert len(sent) == 1
+    digest = sent[0][1]
+    assert "Catch-up: 5 battles" in digest
+    assert "4W / ❌ 1L (80.0%)" in digest
+    assert "Win streak: 3" in digest
+    assert "12:00 – 12:04 UTC" in digest
+
+    # ---- Дальше — снова по сообщению на бой ----
+    assert bot.process_battle_log("#A", make_log([True, False, True, True, True, False])) == 1
+    assert len(sent) == 2
+    assert "Defeat" in sent[1][1]
+    assert bot.get_totals("#A") == {"player_tag": "#A", "games": 6, "wins": 4}
+
+
+def test_cursor_survives_restart(bot, sent, monkeypatch):
+    subscribe(bot, 1, "#A")
+    log = make_log([True, False])
+    bot.process_battle_log("#A", log)
+
+    # ---- Новый процесс: курсор и бои берутся из базы ----
+    bot.battle_cursors.clear()
+    bot.streaks.clear()
+    monkeypatch.setattr(bot, "cursors_loaded", False)
+    bot.load_battle_cursors()
+    assert bot.process_battle_log("#A", log) == 0
+    assert len(sent) == 2
+
+
+def fail_once(monkeypatch, target, name):
+    original = getattr(target, name)
+    calls = []
+
+    def flaky(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError(f"{name} failed")
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(target, name, flaky)
+
+
+@pytest.mark.parametrize("failing", ["save_battles", "increment_totals", "save_cursor"])
+def test_retry_after_failed_write_does_not_double_count(bot, sent, monkeypatch, failing):
+    subscribe(bot, 1, "#A")
+    log = make_log([True, True, False])
+    # ---- Тег уже опрашивался: курсор стоит на первом бое ----
+    bot.process_battle_log("#A", log[-1:])
+    fail_once(monkeypatch, bot.storage, failing)
+
+    with pytest.raises(RuntimeError):
+        bot.process_battle_log("#A", log)
+    # ---- Как в check_new_battles: состояние в памяти сбрасывается, тег повторяется ----
+    bot.drop_streak_state("#A")
+    assert bot.process_battle_log("#A", log) == 2
+
+    assert bot.storage.count_battles("#A") == 3
+    rollup = bot.storage.load_rollups("#A", ["2026-10-16"])[0]
+    assert (rollup["games"], rollup["wins"], rollup["losses"], rollup["max_win_streak"]) == (3, 2, 1, 2)
+    assert bot.get_totals("#A") == {"player_tag": "#A", "games": 3, "wins": 2}
+    assert len(sent) == 3
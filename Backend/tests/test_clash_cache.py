@@ -0,0 +1,59 @@
+import main
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers or {}
+        self.text = ""
+
+    def json(self):
+        return self.data
+
+
+def make_cache(monkeypatch, responses):
+    clock = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    sent_headers = []
+
+    def fake_request(path, headers=None):
+        sent_headers.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr(main, "clash_request", fake_request)
+    return main.ClashResponseCache(10), clock, sent_headers
+
+
+def test_only_fresh_entries_count_as_hits(monkeypatch):
+    cache, clock, sent_headers = make_cache(monkeypatch, [
+        FakeResponse(200, [1], {"ETag": '"v1"', "Cache-Control": "max-age=30"}),
+        FakeResponse(304, headers={"Cache-Control": "max-age=30"}),
+        FakeResponse(200, [2], {"ETag": '"v2"', "Cache-Control": "max-age=30"})
+    ])
+
+    assert cache.fetch("/log") == (200, [1])
+    assert cache.fetch("/log") == (200, [1])
+    clock[0] += 31
+    assert cache.fetch("/log") == (200, [1])
+    clock[0] += 31
+    assert cache.fetch("/log") == (200, [2])
+
+    assert sent_headers == [None, {"If-None-Match": '"v1"'}, {"If-None-Match": '"v1"'}]
+    assert cache.entries.stats() == {"size": 1, "hits": 1, "misses": 2}
+
+
+def test_stale_entry_without_etag_is_dropped(monkeypatch):
+    cache, clock, sent_headers = make_cache(monkeypatch, [
+        FakeResponse(200, [1], {"Cache-Control": "max-age=30"}),
+        FakeResponse(200, [2], {"Cache-Control": "max-age=30"})
+    ])
+
+    cache.fetch("/a")
+    clock[0] += 61
+    assert cache.entries.stats()["size"] == 1
+    # ---- Протухшая запись без ETag вычищается при следующей записи в кэш ----
+    cache.fetch("/b")
+    assert cache.entries.stats()["size"] == 1
+    assert cache.entries.peek("/a") is None
+    assert sent_headers == [None, None]
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from graphs import downsample_lttb, winrate_series
+
+
+def test_winrate_series_is_cumulative():
+    games, rates = winrate_series([True, False, True, True])
+    assert games.tolist() == [1, 2, 3, 4]
+    assert rates.tolist() == pytest.approx([100, 50, 200 / 3, 75])
+
+
+def test_downsample_lttb_keeps_endpoints_and_peaks():
+    x = np.arange(1000, dtype=np.float64)
+    y = np.zeros(1000)
+    y[437] = 50
+    sx, sy = downsample_lttb(x, y, 50)
+
+    assert len(sx) == len(sy) == 50
+    assert sx[0] == 0 and sx[-1] == 999
+    assert np.all(np.diff(sx) > 0)
+    assert 437 in sx.tolist()
+
+
+def test_downsample_lttb_leaves_short_series():
+    x = np.arange(10, dtype=np.float64)
+    y = x * 2
+    sx, sy = downsample_lttb(x, y, 50)
+    assert sx is x and sy is y
@@ -0,0 +1,72 @@
+from datetime import date
+
+import main
+
+
+def test_rolling_average_skips_missing_values():
+    avg = main.RollingAverage(3)
+    assert avg.average() is None
+    for value in (10, None, 20, 30):
+        avg.push(value)
+    # ---- Окно: None, 20, 30 ----
+    assert avg.average() == 25
+    avg.push(None)
+    avg.push(None)
+    assert avg.average() == 30
+    avg.push(None)
+    assert avg.average() is None
+
+
+def test_advance_streak():
+    state = (None, 0)
+    for won in (True, True, True):
+        state = main.advance_streak(state, won)
+    assert state == (True, 3)
+    assert main.advance_streak(state, False) == (False, 1)
+
+
+def test_add_to_rollup_tracks_win_runs():
+    rollup = main.empty_rollup("#A", date(2026, 10, 16))
+    for won in (True, True, False, True):
+        main.add_to_rollup(rollup, won, 3 if won else 1, 30 if won else -30)
+
+    assert rollup["games"] == 4
+    assert rollup["wins"] == 3
+    assert rollup["losses"] == 1
+    assert rollup["crowns"] == 10
+    assert rollup["trophy_delta"] == 60
+    assert rollup["max_win_streak"] == 2
+    assert rollup["win_run"] == 1
+
+
+def test_circuit_breaker_opens_and_half_opens(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    breaker = main.CircuitBreaker("test", threshold=2, reset_timeout=30)
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    # ---- После паузы пропускается ровно один пробный запрос ----
+    clock[0] += 31
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock[0] += 31
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_cache_lifetime():
+    assert main.cache_lifetime({}, 5) == 5
+    assert main.cache_lifetime({"Cache-Control": "public, max-age=120"}, 5) == 120
+    assert main.cache_lifetime({"Cache-Control": "max-age=abc"}, 5) == 5
+    assert main.cache_lifetime({"Cache-Control": "no-cache"}, 5) == 0
+    assert main.cache_lifetime({"Cache-Control": "no-store, max-age=60"}, 5) is None
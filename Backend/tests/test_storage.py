@@ -0,0 +1,66 @@
+import pytest
+
+from storage import Storage
+
+
+def battle_row(tag, battle_time, result):
+    return {
+        "player_tag": tag,
+        "battle_time": battle_time,
+        "result": result,
+        "trophy_change": 30 if result else -30,
+        "crowns": 3 if result else 1,
+        "opponent_crowns": 1 if result else 3,
+        "game_mode": "Ladder",
+        "starting_trophies": 7000
+    }
+
+
+def test_save_battles_dedupes_on_tag_and_time(sqlite_storage):
+    rows = [
+        battle_row("#A", "2026-10-16T12:00:00+00:00", True),
+        battle_row("#A", "2026-10-16T12:01:00+00:00", False)
+    ]
+    assert sqlite_storage.save_battles(rows) == rows
+    extra = battle_row("#B", "2026-10-16T12:00:00+00:00", True)
+    # ---- Возвращаются только реально вставленные строки ----
+    assert sqlite_storage.save_battles(rows + [extra]) == [extra]
+
+    assert sqlite_storage.count_battles("#A") == 2
+    assert sqlite_storage.count_battles("#A", wins_only=True) == 1
+    assert sqlite_storage.count_battles("#B") == 1
+    assert sqlite_storage.battle_times_since("#A", "2026-10-16T12:01:00+00:00") == ["2026-10-16T12:01:00+00:00"]
+
+
+def test_totals_increment_only_existing_rows(sqlite_storage):
+    assert not sqlite_storage.increment_totals("#A", 2, 1)
+    assert sqlite_storage.create_totals({"player_tag": "#A", "games": 5, "wins": 3})
+    assert not sqlite_storage.create_totals({"player_tag": "#A", "games": 0, "wins": 0})
+    assert sqlite_storage.increment_totals("#A", 2, 1)
+    assert sqlite_storage.get_totals("#A") == {"player_tag": "#A", "games": 7, "wins": 4}
+
+
+def test_lease_claim_and_handover(sqlite_storage):
+    now = "2026-10-16T12:00:00+00:00"
+    later = "2026-10-16T12:01:00+00:00"
+
+    assert sqlite_storage.claim_leases(["#A", "#B"], "one", now, later) == ["#A", "#B"]
+    # ---- Живую чужую аренду не отнять ----
+    assert sqlite_storage.claim_leases(["#A", "#B"], "two", now, later) == []
+    # ---- Продление своей аренды ----
+    assert sqlite_storage.claim_leases(["#A"], "one", now, "2026-10-16T12:05:00+00:00") == ["#A"]
+
+    # ---- Освобождённый тег забирают сразу, просроченный — после expires_at ----
+    sqlite_storage.release_leases(["#B"], "one")
+    assert sqlite_storage.claim_leases(["#A", "#B"], "two", now, later) == ["#B"]
+    assert sqlite_storage.claim_leases(["#A"], "two", "2026-10-16T12:06:00+00:00", "2026-10-16T12:07:00+00:00") == ["#A"]
+    assert sqlite_storage.claim_leases(["#A"], "one", "2026-10-16T12:06:00+00:00", "2026-10-16T12:07:00+00:00") == []
+
+
+def test_incomplete_backend_fails_on_construction():
+    class Partial(Storage):
+        def ensure_user(self, chat_id, username):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
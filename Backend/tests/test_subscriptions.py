@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+def test_changes_during_reload_are_kept(bot, monkeypatch):
+    bot.storage.add_subscription(1, "#OLD")
+    bot.storage.add_subscription(2, "#GONE")
+    index = bot.subscription_index
+    original = bot.storage.all_subscriptions
+
+    def read_then_race():
+        rows = original()
+        # ---- /add и /remove срабатывают между чтением из БД и заменой карт ----
+        index.add(1, "#NEW")
+        index.remove(2, "#GONE")
+        return rows
+
+    monkeypatch.setattr(bot.storage, "all_subscriptions", read_then_race)
+    index.reload()
+
+    assert sorted(index.tags()) == ["#NEW", "#OLD"]
+    assert index.subscribers("#GONE") == []
+    assert index.is_subscribed(1, "#NEW")
+
+
+def test_one_reload_at_a_time(bot, monkeypatch):
+    bot.storage.add_subscription(1, "#A")
+    index = bot.subscription_index
+    original = bot.storage.all_subscriptions
+    calls = []
+
+    def slow_read():
+        calls.append(1)
+        time.sleep(0.05)
+        return original()
+
+    monkeypatch.setattr(bot.storage, "all_subscriptions", slow_read)
+    threads = [threading.Thread(target=index.tags) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert index.subscribers("#A") == [1]